@@ -0,0 +1,46 @@
+"""
+Hashing throughput of this machine, per CRC32C backend and for md5:
+
+    python -m filedb.benchmark [size in MiB]
+"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from filedb import hash
+
+
+def _throughput(function, size: int) -> float:
+    start = time.perf_counter()
+    function()
+    return size / (time.perf_counter() - start) / 1024 / 1024
+
+
+def run(size: int = 256 * 1024 * 1024):
+    """Prints MB/s of hashing a file of size bytes, and of hashing it in memory."""
+    data = os.urandom(size)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'data'
+        path.write_bytes(data)
+
+        for name in hash.backends():
+            if name == 'python':
+                # about a MB/s, a smaller sample will do
+                sample = data[:1024 * 1024]
+                memory = _throughput(lambda: hash.Crc32c(name).update(sample), len(sample))
+                print(f'crc32c {name:14} memory {memory:9.1f} MB/s')
+                continue
+
+            crc = hash.Crc32c(name)
+            memory = _throughput(lambda: crc.update(data), size)
+            file = _throughput(lambda: hash.crc32c(path, name), size)
+            selected = ' (selected)' if name == hash.backend() else ''
+            print(f'crc32c {name:14} memory {memory:9.1f} MB/s, file {file:9.1f} MB/s{selected}')
+
+        print(f'md5                   file   {_throughput(lambda: hash.md5(path), size):9.1f} MB/s')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024)
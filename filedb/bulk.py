@@ -0,0 +1,209 @@
+import io
+import itertools
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from filedb.db import File
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _ByteBudget:
+    """Bytes read but not yet consumed. One file is let through even if over budget."""
+
+    def __init__(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int):
+        with self.condition:
+            self.condition.wait_for(lambda: (self.cancelled or
+                                             self.max_bytes is None or
+                                             self.in_flight == 0 or
+                                             self.in_flight + size <= self.max_bytes))
+            if self.cancelled:
+                raise _Cancelled
+            self.in_flight += size
+
+    def release(self, size: int):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+
+def _read(file: 'File', budget: _ByteBudget):
+    with file.open('rb') as f:
+        try:
+            size = os.fstat(f.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            size = None
+
+        if size is None:
+            data = f.read()
+            size = len(data)
+            budget.acquire(size)
+        else:
+            budget.acquire(size)
+            try:
+                data = f.read()
+            except BaseException:
+                budget.release(size)
+                raise
+            # the file could have been of a different size than stat said
+            budget.release(size - len(data))
+            size = len(data)
+
+    return file, data, size
+
+
+def read_many(files: Iterable['File'],
+              max_workers: int = 8,
+              max_inflight_bytes: Optional[int] = None) -> Iterator[Tuple['File', bytes]]:
+    """Reads files concurrently, yielding (file, data) in the order reads complete.
+
+    At most max_inflight_bytes are held by reads that were not consumed yet, so reading
+    ahead stops while the consumer is busy. Files should be bound to their storage paths,
+    otherwise each of them looks its own up.
+    """
+    files = iter(files)
+    budget = _ByteBudget(max_inflight_bytes)
+    executor = ThreadPoolExecutor(max_workers)
+    pending = set()
+    try:
+        while True:
+            for file in itertools.islice(files, max(0, 2 * max_workers - len(pending))):
+                pending.add(executor.submit(_read, file, budget))
+
+            if not pending:
+                return
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file, data, size = future.result()
+                try:
+                    yield file, data
+                finally:
+                    budget.release(size)
+    finally:
+        budget.cancel()
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class Prefetch:
+    """Handle of files being downloaded to cache in the background.
+
+    Progress is in files_done and bytes_done (downloaded), files_skipped (already cached)
+    and errors, a list of (file, exception).
+
+    prefetch_file(file, reserve) downloads a file and returns its size, or None if it was
+    cached already. With max_bytes, it is given reserve(size) to call before downloading,
+    which raises (and stops the prefetch) once a file does not fit the bytes left, so
+    concurrent downloads can not overshoot max_bytes. The first file is let through even if
+    over max_bytes.
+    """
+
+    def __init__(self,
+                 files: Iterable['File'],
+                 prefetch_file: Callable[['File', Optional[Callable[[int], None]]],
+                                         Optional[int]],
+                 max_workers: int = 8,
+                 max_bytes: Optional[int] = None):
+        self.files_done = 0
+        self.files_skipped = 0
+        self.bytes_done = 0
+        self.errors: List[Tuple[Optional['File'], Exception]] = []
+        self.max_bytes = max_bytes
+        self._bytes_reserved = 0  # by downloads done or running
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(files, prefetch_file, max_workers),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, files, prefetch_file, max_workers):
+        files = iter(files)
+        pending = set()
+        with ThreadPoolExecutor(max_workers) as executor:
+            try:
+                while not self._cancelled.is_set():
+                    for file in itertools.islice(files, max(0, 2 * max_workers - len(pending))):
+                        pending.add(executor.submit(self._prefetch, prefetch_file, file))
+                    if not pending:
+                        break
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            except Exception as e:  # listing files failed
+                with self._lock:
+                    self.errors.append((None, e))
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _reserve(self, size: int):
+        with self._lock:
+            if self._cancelled.is_set():
+                raise _Cancelled
+            if self._bytes_reserved > 0 and self._bytes_reserved + size > self.max_bytes:
+                self._cancelled.set()
+                raise _Cancelled
+            self._bytes_reserved += size
+
+    def _prefetch(self, prefetch_file, file):
+        if self._cancelled.is_set():
+            return
+        reserved = []
+
+        def reserve(size):
+            self._reserve(size)
+            reserved.append(size)
+
+        try:
+            size = prefetch_file(file, None if self.max_bytes is None else reserve)
+        except _Cancelled:
+            return
+        except Exception as e:
+            with self._lock:
+                self.errors.append((file, e))
+                self._bytes_reserved -= sum(reserved)
+            return
+        with self._lock:
+            # what was downloaded could differ from what was reserved
+            self._bytes_reserved += (size or 0) - sum(reserved)
+            if size is None:
+                self.files_skipped += 1
+            else:
+                self.files_done += 1
+                self.bytes_done += size
+
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        self._thread.join(timeout)
+        return self.done()
+
+    def cancel(self):
+        """Stops starting new downloads, the ones running are finished."""
+        self._cancelled.set()
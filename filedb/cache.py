@@ -1,23 +1,45 @@
+import atexit
 import json
+import os
 import shutil
 import sqlite3
 import tempfile
+import threading
 import time
 import uuid
+import weakref
 from contextlib import contextmanager
 from pathlib import Path
+from typing import Callable
 from typing import Optional
+from typing import Type
+from typing import Union
 
 import atomicwrites
 from dataclasses import dataclass
 
 from filedb import hash
 from filedb.lock import FileLocked
+from filedb.lock import FlockReaderWriterLock
 from filedb.lock import ReaderWriterLock
 
+Lock = Type[Union[ReaderWriterLock, FlockReaderWriterLock]]
+
 READ = object()
 WRITE = object()
 
+# registries with access times to flush at exit, weakly referenced so that they can be collected
+_registries = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_registries_at_exit():
+    for registry in list(_registries):
+        try:
+            registry.flush()
+        except (OSError, sqlite3.Error):
+            pass  # cache removed meanwhile
+
 
 class FileNotCachedError(Exception):
     pass
@@ -29,63 +51,246 @@ class _CachePaths:
     data: Path
     crc32c: Path  # doubles as a marker that the write was completed
 
+    @classmethod
+    def from_directory(cls, directory: Path):
+        return cls(directory=directory,
+                   data=directory / 'data',
+                   crc32c=directory / 'crc32c')
+
+
+@dataclass
+class _Partial:
+    path: Path
+    crc32c: Optional[str] = None  # if known by the writer
+
 
 class Cache:
 
     def __init__(self,
                  root_path: Path = Path(tempfile.gettempdir()) / 'filedb',
-                 size: Optional[float] = shutil.disk_usage(tempfile.gettempdir()).free / 5):
+                 size: Optional[float] = shutil.disk_usage(tempfile.gettempdir()).free / 5,
+                 low_water_mark: float = 0.8,
+                 wal_registry: bool = False,
+                 lock_class: Lock = ReaderWriterLock):
         self.root_path = Path(root_path)
         self.size = size
-        self.registry = CacheRegistry(self.root_path, size)
+        self.lock_class = lock_class
+        if wal_registry:
+            self.registry = WALCacheRegistry(self.root_path, size, low_water_mark, lock_class)
+        else:
+            self.registry = CacheRegistry(self.root_path, size, low_water_mark, lock_class)
 
-    def _paths(self, storage_path, storage_name, index_name):
+    def _paths(self, storage_path, storage_name, index_name, create=True):
         directory = self.root_path.joinpath(index_name, storage_name, storage_path)
-        directory.mkdir(parents=True, exist_ok=True)
-        return _CachePaths(directory=directory,
-                           data=directory / 'data',
-                           crc32c=directory / 'crc32c')
-
-    @contextmanager
-    def writing_path(self, storage_path, storage_name, index_name, timeout):
+        if create:
+            directory.mkdir(parents=True, exist_ok=True)
+        return _CachePaths.from_directory(directory)
 
+    def _cleanup(self, timeout):
         try:
-            with ReaderWriterLock(self.root_path).write_lock(timeout=timeout):
+            with self.lock_class(self.root_path).write_lock(timeout=timeout):
                 self.registry.cleanup()
         except FileLocked:
             pass  # someone else is cleaning up, ok to proceed
 
-        paths = self._paths(storage_path, storage_name, index_name)
+    @staticmethod
+    def _is_complete(paths: _CachePaths):
+        return paths.crc32c.exists() and paths.data.exists()
+
+    def is_complete(self, storage_path, storage_name, index_name) -> bool:
+        # completed entries never change, no lock needed
+        return self._is_complete(self._paths(storage_path, storage_name, index_name,
+                                             create=False))
+
+    @contextmanager
+    def _written(self, paths: _CachePaths):
+        # must hold the write lock of paths.directory
 
-        with ReaderWriterLock(paths.directory).write_lock(timeout=timeout):
+        # register intent and mark directory as incomplete
+        self.registry.register_write_intent(paths)
+        try:
+            paths.crc32c.unlink()
+        except FileNotFoundError:
+            pass
+        for partial in paths.directory.glob('*.partial'):  # left over by crashed writers
+            partial.unlink()
 
-            # register intent and mark directory as incomplete
-            self.registry.register_write_intent(paths)
+        # allow client to write, data appears only once complete
+        partial = _Partial(paths.directory / f'{uuid.uuid4()}.partial')
+        try:
+            yield partial
+            crc32c = partial.crc32c or hash.crc32c(partial.path)
+            partial.path.replace(paths.data)
+        finally:
             try:
-                paths.crc32c.unlink()
+                partial.path.unlink()
             except FileNotFoundError:
                 pass
 
-            # allow client to write
-            yield paths.data
+        # mark as complete and register write
+        with atomicwrites.atomic_write(paths.crc32c) as f:
+            json.dump(crc32c, f)
+        self.registry.register_write_complete(paths)
+        self.registry.register_access(paths)
 
-            # mark as complete and register write
-            with atomicwrites.atomic_write(paths.crc32c) as f:
-                json.dump(hash.crc32c(paths.data), f)
-            self.registry.register_write_complete(paths)
-            self.registry.register_access(paths)
+    @contextmanager
+    def writing_path(self, storage_path, storage_name, index_name, timeout):
+
+        self._cleanup(timeout)
+        paths = self._paths(storage_path, storage_name, index_name)
+
+        with self.lock_class(paths.directory).write_lock(timeout=timeout):
+            with self._written(paths) as partial:
+                yield partial.path
+
+    @contextmanager
+    def writing_handle(self,
+                       storage_path,
+                       storage_name,
+                       index_name,
+                       timeout,
+                       mode='wb',
+                       buffering=-1,
+                       encoding=None,
+                       errors=None,
+                       newline=None):
+        """Yields file opened for writing, hashed while written instead of re-read after."""
+
+        self._cleanup(timeout)
+        paths = self._paths(storage_path, storage_name, index_name)
+
+        with self.lock_class(paths.directory).write_lock(timeout=timeout):
+            with self._written(paths) as partial:
+                f, crc32c = hash.hashing_open(partial.path,
+                                              mode=mode,
+                                              buffering=buffering,
+                                              encoding=encoding,
+                                              errors=errors,
+                                              newline=newline)
+                with f:
+                    yield f
+                partial.crc32c = crc32c()
 
     @contextmanager
     def reading_path(self, storage_path, storage_name, index_name, timeout):
 
         paths = self._paths(storage_path, storage_name, index_name)
-        with ReaderWriterLock(paths.directory).read_lock(timeout=timeout):
-            if paths.crc32c.exists() and paths.data.exists():
+        with self.lock_class(paths.directory).read_lock(timeout=timeout):
+            if self._is_complete(paths):
                 self.registry.register_access(paths)
                 yield paths.data
             else:
                 raise FileNotCachedError
 
+    @contextmanager
+    def fetching_path(self,
+                      storage_path,
+                      storage_name,
+                      index_name,
+                      fetch: Callable[[Path], Optional[str]]):
+        """Yields path of a complete cached file, calling fetch(path) to write it if missing.
+
+        fetch may return crc32c of what it wrote, to spare hashing the file again.
+
+        Of all threads and processes missing the same file at once, only one fetches it.
+        The others wait until its write lock is released and read the fetched file. If
+        fetch raises, the exception propagates to its caller only.
+        """
+        paths = self._paths(storage_path, storage_name, index_name)
+
+        while True:
+            with self.lock_class(paths.directory).read_lock(timeout=None):
+                if self._is_complete(paths):
+                    self.registry.register_access(paths)
+                    yield paths.data
+                    return
+
+            self._cleanup(timeout=0)
+            try:
+                with self.lock_class(paths.directory).write_lock(timeout=0):
+                    # might have been fetched by someone else since the check above
+                    if not self._is_complete(paths):
+                        with self._written(paths) as partial:
+                            partial.crc32c = fetch(partial.path)
+            except FileLocked:
+                pass  # someone else is fetching, wait for the write lock on the read lock
+
+    @contextmanager
+    def opened(self,
+               storage_path,
+               storage_name,
+               index_name,
+               fetch: Callable[[Path], Optional[str]],
+               mode='r',
+               buffering=-1,
+               encoding=None,
+               errors=None,
+               newline=None):
+        """Yields cached file opened for reading, calling fetch(path) to write it if missing.
+
+        Completed entries never change, so hits are opened without any lock, and their access
+        time is buffered by the registry (which takes its lock only to flush them every
+        flush_interval seconds). Eviction moves data out of the entry before deleting it,
+        which does not affect open handles.
+        """
+        open_params = dict(mode=mode,
+                           buffering=buffering,
+                           encoding=encoding,
+                           errors=errors,
+                           newline=newline)
+
+        paths = self._paths(storage_path, storage_name, index_name, create=False)
+        f = None
+        if paths.crc32c.exists():
+            try:
+                f = paths.data.open(**open_params)
+            except FileNotFoundError:
+                pass  # evicted meanwhile
+
+        if f is None:
+            with self.fetching_path(storage_path, storage_name, index_name, fetch) as path:
+                f = path.open(**open_params)
+        else:
+            self.registry.register_access(paths)
+
+        with f:
+            yield f
+
+    def move(self, storage_path, to_storage_path, storage_name, index_name):
+        """Moves a complete entry to another storage path, dropping it if that is cached.
+
+        The directory of the moved entry is removed, so it must not be used by anyone else,
+        like entries of temporary storage paths.
+        """
+        paths = self._paths(storage_path, storage_name, index_name)
+        to_paths = self._paths(to_storage_path, storage_name, index_name)
+
+        with self._removed(paths):
+            if not self._is_complete(paths):
+                raise FileNotCachedError
+            with self.lock_class(to_paths.directory).write_lock(timeout=None):
+                if not self._is_complete(to_paths):
+                    with self._written(to_paths) as partial:
+                        partial.crc32c = json.loads(paths.crc32c.read_text())
+                        paths.data.replace(partial.path)
+
+    def evict(self, storage_path, storage_name, index_name):
+        """Removes the entry of a file that is no longer used, open handles stay readable."""
+        paths = self._paths(storage_path, storage_name, index_name, create=False)
+        if not paths.directory.exists():
+            return
+        with self._removed(paths):
+            pass
+
+    @contextmanager
+    def _removed(self, paths: _CachePaths):
+        # yields holding the write lock of the entry, then evicts it and removes its directory,
+        # unless an exception was raised
+        with self.lock_class(paths.directory).write_lock(timeout=None):
+            yield
+            self.registry.evict(paths)
+        shutil.rmtree(str(paths.directory), ignore_errors=True)
+
     def crc32c(self, storage_path, storage_name, index_name):
         paths = self._paths(storage_path, storage_name, index_name)
         try:
@@ -95,19 +300,33 @@ class Cache:
 
 
 class CacheRegistry:
+    """Registry of cached files, their sizes and access times, in SQLite.
+
+    Writes and evictions are registered right away, under a lock of the registry directory.
+    Access times are buffered in memory and written in one transaction every flush_interval
+    seconds, before cleanup, and at exit, so that cache hits take no lock in between.
+    """
+    _pid = None
 
     def __init__(self,
                  cache_root_path: Path,
-                 size: Optional[float]):
+                 size: Optional[float],
+                 low_water_mark: float = 0.8,
+                 lock_class: Lock = ReaderWriterLock,
+                 flush_interval: float = 5.):
 
         self.cache_root_path = cache_root_path
         self.size = size
+        self.low_water_mark = low_water_mark
+        self.lock_class = lock_class
+        self.flush_interval = flush_interval
         self.registry_dir = cache_root_path / 'registry'
         self.registry_db_path = self.registry_dir / 'db.sqlite'
+        self.trash_dir = cache_root_path / 'trash'
 
         # initialize, if database does not exist yet
         if not self.registry_db_path.exists():
-            with ReaderWriterLock(self.registry_dir).write_lock(timeout=None):
+            with self.lock_class(self.registry_dir).write_lock(timeout=None):
                 if not self.registry_db_path.exists():
                     temp_path = self.registry_dir / str(uuid.uuid4())
                     conn = sqlite3.connect(str(temp_path))
@@ -124,42 +343,220 @@ class CacheRegistry:
                                  'path text not null, '
                                  'write_start_time integer not null);')
 
+                    self._create_usage_table(conn)
+
                     conn.commit()
                     conn.close()
                     temp_path.replace(self.registry_db_path)
 
+        # registries created before usage was tracked
+        if not self._has_usage_table():
+            with self.lock_class(self.registry_dir).write_lock(timeout=None):
+                if not self._has_usage_table():
+                    with self._connection() as conn:
+                        self._create_usage_table(conn)
+
+    def __getstate__(self):
+        # locks and connections can not be pickled, buffered accesses stay with this process
+        state = self.__dict__.copy()
+        for attribute in ('_pid', '_lock', '_conn', '_accesses', '_last_flush'):
+            state.pop(attribute, None)
+        return state
+
+    def _process_state(self):
+        # locks are not fork safe, and buffered accesses belong to the parent
+        if self._pid != os.getpid():
+            self._lock = threading.RLock()
+            self._accesses = {}
+            self._last_flush = time.monotonic()
+            self._pid = os.getpid()
+            _registries.add(self)
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(str(self.registry_db_path))
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self.lock_class(self.registry_dir).write_lock(timeout=None):
+            with self._connection() as conn:
+                with conn:
+                    yield conn
+
+    @staticmethod
+    def _create_usage_table(conn: sqlite3.Connection):
+        conn.executescript('begin immediate;'
+                           'create table cache_usage (total_size integer not null);'
+                           'insert into cache_usage '
+                           'select coalesce(sum(size), 0) from cached_files;'
+                           'commit;')
+
+    def _has_usage_table(self):
+        with self._connection() as conn:
+            result = conn.execute("select name from sqlite_master "
+                                  "where type = 'table' and name = 'cache_usage';").fetchone()
+        return result is not None
+
+    def usage(self) -> int:
+        with self._connection() as conn:
+            total_size, = conn.execute('select total_size from cache_usage;').fetchone()
+        return total_size
+
+    def _least_recently_accessed(self, batch_size=1000):
+        last = (float('-inf'), '')
+        while True:
+            with self._connection() as conn:
+                rows = conn.execute('select path, size, last_access_time from cached_files '
+                                    'where last_access_time > ? '
+                                    'or (last_access_time = ? and path > ?) '
+                                    'order by last_access_time, path limit ?;',
+                                    (last[0], last[0], last[1], batch_size)).fetchall()
+            if not rows:
+                return
+            for path, size, last_access_time in rows:
+                yield path, size
+            last = (rows[-1][2], rows[-1][0])
+
     def cleanup(self):
-        pass
+        """Evicts least recently accessed files until usage falls below low water mark.
+
+        Files that are being written, or read with a lock, are skipped. So are files open
+        on platforms that do not allow to move them (windows).
+        """
+        if self.size is None:
+            return
+
+        self.flush()
+        usage = self.usage()
+        if usage <= self.size:
+            return
+
+        for path, size in self._least_recently_accessed():
+            if usage <= self.size * self.low_water_mark:
+                break
+            paths = _CachePaths.from_directory(Path(path))
+            try:
+                with self.lock_class(paths.directory).write_lock(timeout=0):
+                    self.evict(paths)
+            except (FileLocked, PermissionError):
+                continue
+            usage -= size
 
-    def register_write_intent(self, paths: _CachePaths):
+        self._empty_trash()
 
-        with ReaderWriterLock(self.registry_dir).write_lock(timeout=None):
-            conn = sqlite3.connect(str(self.registry_db_path))
-            conn.execute('insert into pending_files values (?, ?)',
-                         (str(paths.directory), int(time.time())))
-            conn.commit()
-            conn.close()
+    def evict(self, paths: _CachePaths):
+        """Removes the data of an entry, the caller must hold its write lock.
 
-    def register_write_complete(self, paths: _CachePaths):
+        Data is moved out first, lock free readers that find it have it open already.
+        """
+        self.trash_dir.mkdir(exist_ok=True)
+        try:
+            paths.data.replace(self.trash_dir / str(uuid.uuid4()))
+        except FileNotFoundError:
+            pass
+        try:
+            paths.crc32c.unlink()
+        except FileNotFoundError:
+            pass
+        self.register_eviction(paths)
 
-        with ReaderWriterLock(self.registry_dir).write_lock(timeout=None):
-            conn = sqlite3.connect(str(self.registry_db_path))
-            size = paths.data.stat().st_size
-            # TODO there must be a safer way
-            script = f"""
-             begin transaction;
-             insert into cached_files values ("{paths.directory}", {size}, {int(time.time())});
-             delete from pending_files where path = "{paths.directory}";
-             commit;
-            """
-            conn.executescript(script)
-            conn.commit()
-            conn.close()
+    def _empty_trash(self):
+        if not self.trash_dir.exists():
+            return
+        for path in self.trash_dir.iterdir():
+            try:
+                path.unlink()
+            except OSError:
+                pass  # still open somewhere, next time
+
+    def register_write_intent(self, paths: _CachePaths):
+        with self._transaction() as conn:
+            conn.execute('insert into pending_files values (?, ?);',
+                         (str(paths.directory), time.time()))
+
+    def register_write_complete(self, paths: _CachePaths):
+        size = paths.data.stat().st_size
+        with self._transaction() as conn:
+            self._unregister(conn, paths)
+            conn.execute('insert into cached_files values (?, ?, ?);',
+                         (str(paths.directory), size, time.time()))
+            conn.execute('delete from pending_files where path = ?;', (str(paths.directory),))
+            conn.execute('update cache_usage set total_size = total_size + ?;', (size,))
+
+    def register_eviction(self, paths: _CachePaths):
+        with self._transaction() as conn:
+            self._unregister(conn, paths)
+
+    @staticmethod
+    def _unregister(conn: sqlite3.Connection, paths: _CachePaths):
+        result = conn.execute('select size from cached_files where path = ?;',
+                              (str(paths.directory),)).fetchone()
+        if result is not None:
+            conn.execute('delete from cached_files where path = ?;', (str(paths.directory),))
+            conn.execute('update cache_usage set total_size = total_size - ?;', result)
 
     def register_access(self, paths: _CachePaths):
-        with ReaderWriterLock(self.registry_dir).write_lock(timeout=None):
-            conn = sqlite3.connect(str(self.registry_db_path))
-            conn.execute('update cached_files set last_access_time = ? where path = ?;',
-                         (int(time.time()), str(paths.directory)))
-            conn.commit()
-            conn.close()
+        self._process_state()
+        with self._lock:
+            self._accesses[str(paths.directory)] = time.time()
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        self._process_state()
+        with self._lock:
+            accesses, self._accesses = self._accesses, {}
+            self._last_flush = time.monotonic()
+            if accesses:
+                with self._transaction() as conn:
+                    conn.executemany('update cached_files set last_access_time = ? '
+                                     'where path = ?;',
+                                     [(t, path) for path, t in accesses.items()])
+
+
+class WALCacheRegistry(CacheRegistry):
+    """Registry that keeps one WAL mode connection per process and relies on SQLite locking."""
+
+    def __init__(self,
+                 cache_root_path: Path,
+                 size: Optional[float],
+                 low_water_mark: float = 0.8,
+                 lock_class: Lock = ReaderWriterLock,
+                 flush_interval: float = 5.,
+                 busy_timeout: float = 60.):
+        self.busy_timeout = busy_timeout
+        super().__init__(cache_root_path, size, low_water_mark, lock_class, flush_interval)
+
+    def _process_state(self):
+        # connections are not fork safe either
+        if self._pid != os.getpid():
+            self._conn = None
+        super()._process_state()
+
+    @contextmanager
+    def _connection(self):
+        self._process_state()
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(str(self.registry_db_path),
+                                             timeout=self.busy_timeout,
+                                             isolation_level=None,
+                                             check_same_thread=False)
+                self._conn.execute('pragma journal_mode=wal;')
+            yield self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            conn.execute('begin immediate;')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('rollback;')
+                raise
+            else:
+                conn.execute('commit;')
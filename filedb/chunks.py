@@ -0,0 +1,14 @@
+import itertools
+from typing import Iterable
+from typing import Iterator
+from typing import List
+
+
+def chunked(iterable: Iterable, chunk_size: int) -> Iterator[List]:
+    """Yields lists of chunk_size consecutive items, the last one possibly shorter."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,172 @@
+"""
+Columnar query results. numpy (and pandas, for data frames) are imported only when used.
+"""
+from typing import Any
+from typing import Collection
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from dataclasses import dataclass
+
+from filedb.chunks import chunked
+from filedb.key import Key
+from filedb.key import Value
+
+CHUNK_SIZE = 10000
+
+_MISSING = object()
+
+
+@dataclass
+class Column:
+    values: Any  # numpy array, codes into categories if categorical
+    mask: Any  # numpy bool array, True where the key has no such field
+    categories: Optional[List[Value]] = None
+
+    @property
+    def categorical(self):
+        return self.categories is not None
+
+
+def _get(key: Key, field: str):
+    value = key
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+class _ColumnBuilder:
+
+    def __init__(self, field: str, categorical: bool):
+        self.field = field
+        self.categories = [] if categorical else None
+        # by type too, as True, 1 and 1.0 are equal
+        self.codes = {}
+        self.values_chunks = []
+        self.mask_chunks = []
+
+    def add_chunk(self, values: List[Any]):
+        import numpy as np
+
+        mask = np.array([value is _MISSING for value in values], dtype=bool)
+        present = [value for value in values if value is not _MISSING]
+
+        if self.categories is not None:
+            try:
+                codes = [self._code(value) for value in present]
+            except TypeError:
+                raise ValueError(f'Categorical field {self.field} has unhashable values, like '
+                                 f'lists or dicts, make it not categorical!')
+            chunk = np.full(len(values), -1, dtype=np.int32)
+            chunk[~mask] = codes
+        else:
+            present = _array(present)
+            chunk = np.empty(len(values), dtype=present.dtype)
+            if chunk.dtype == object:
+                chunk.fill(None)
+            else:
+                chunk.fill(0)
+            chunk[~mask] = present
+
+        self.values_chunks.append(chunk)
+        self.mask_chunks.append(mask)
+
+    def _code(self, value) -> int:
+        code = self.codes.setdefault((type(value), value), len(self.categories))
+        if code == len(self.categories):
+            self.categories.append(value)
+        return code
+
+    def build(self) -> Column:
+        import numpy as np
+
+        if not self.values_chunks:
+            return Column(values=np.empty(0, dtype=np.int32 if self.categories is not None
+                                          else object),
+                          mask=np.empty(0, dtype=bool),
+                          categories=None if self.categories is None else [])
+
+        # chunks with every value missing have no type of their own
+        dtypes = [chunk.dtype for chunk, mask in zip(self.values_chunks, self.mask_chunks)
+                  if not mask.all()]
+        if not dtypes or (len({dtype.kind for dtype in dtypes}) > 1 and
+                          not {dtype.kind for dtype in dtypes} <= set('biuf')):
+            # types mixed across chunks, numpy would turn numbers into strings
+            dtype = np.dtype(object)
+        else:
+            dtype = np.result_type(*dtypes)
+            if dtype.kind == 'f' and all(dtype.kind in 'biu' for dtype in dtypes):
+                # signed and unsigned 64 bit integers, floats would lose precision
+                dtype = np.dtype(object)
+
+        values = np.concatenate([chunk.astype(dtype) for chunk in self.values_chunks])
+        mask = np.concatenate(self.mask_chunks)
+        if dtype == object:
+            values[mask] = None
+
+        return Column(values=values,
+                      mask=mask,
+                      categories=self.categories)
+
+
+def _array(values: List[Value]):
+    import numpy as np
+
+    try:
+        array = np.asarray(values)
+    except ValueError:  # ragged lists
+        array = None
+    if array is None or array.ndim != 1 or (
+            array.dtype.kind in 'SU' and
+            not all(isinstance(value, (str, bytes)) for value in values)) or (
+            # integers not fitting into 64 bits, floats would lose precision
+            array.dtype.kind == 'f' and all(isinstance(value, int) for value in values)):
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+    return array
+
+
+def columns(keys: Iterable[Key],
+            fields: List[str],
+            categorical: Collection[str] = (),
+            chunk_size: int = CHUNK_SIZE) -> Dict[str, Column]:
+    """Collects values of fields of keys into one numpy array per field.
+
+    Keys are consumed in chunks, so only one chunk of them is in memory at once. Values
+    of categorical fields are stored as int32 codes into a list of categories, -1 where
+    missing, values of categorical fields must be hashable. Dotted fields address nested
+    values.
+    """
+    builders = {field: _ColumnBuilder(field, field in categorical) for field in fields}
+    for chunk in chunked(keys, chunk_size):
+        for field, builder in builders.items():
+            builder.add_chunk([_get(key, field) for key in chunk])
+    return {field: builder.build() for field, builder in builders.items()}
+
+
+def to_dataframe(columns_: Dict[str, Column]):
+    import numpy as np
+    import pandas as pd
+
+    data = {}
+    for field, column in columns_.items():
+        values, mask = column.values, column.mask
+        if column.categorical:
+            data[field] = pd.Categorical.from_codes(values, categories=column.categories)
+        elif not mask.any():
+            data[field] = values
+        elif values.dtype.kind in 'iu':
+            data[field] = pd.arrays.IntegerArray(values, mask)
+        elif values.dtype.kind == 'b':
+            data[field] = pd.arrays.BooleanArray(values, mask)
+        elif values.dtype.kind == 'f':
+            data[field] = np.where(mask, np.nan, values)
+        else:
+            values = values.astype(object)
+            values[mask] = None
+            data[field] = values
+    return pd.DataFrame(data)
@@ -2,24 +2,59 @@ from typing import Any
 
 from dataclasses import dataclass
 from dataclasses import asdict
+import copy
+import itertools
 import logging
+import shutil
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+from typing import Collection
+from typing import Dict
 from typing import IO
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Tuple
 from typing import Union
 
-from filedb import cache
-from filedb import lock
+from pymongo.errors import PyMongoError
+
+from filedb import bulk
+from filedb.chunks import chunked
+from filedb.columns import Column
+from filedb.columns import columns
+from filedb.columns import to_dataframe
+from filedb.hash import sha256_open
+from filedb.index import CHUNK_SIZE
 from filedb.index import Index
+from filedb.index import KeyId
+from filedb.index import Sort
 from filedb.key import Key
 from filedb.key import key_hash
+from filedb.key import Value
 from filedb.query import Query
 from filedb.storage import DirectTransportStorage
 from filedb.storage import SyncStorage
 
 logger = logging.getLogger(__name__)
 
+# what files bound to a storage path do when it turns out to be gone: fail, or look up the
+# current storage path in the index and retry
+TRUST = 'trust'
+REVALIDATE = 'revalidate'
+
+# what happens to files replaced by overwrites and moves, or deleted: deleted right away
+# (readers bound to them then fail or revalidate, see above), or queued for deletion, kept
+# for readers bound to them until filedb.gc.collect_deferred (or collect) deletes them, which
+# must then be run periodically, or queued files are never deleted
+IMMEDIATE = 'immediate'
+DEFERRED = 'deferred'
+
 
 @dataclass
 class _HandleParams:
@@ -30,31 +65,286 @@ class _HandleParams:
     newline: Any = None
 
 
+class SupersededError(Exception):
+    """Not written, as a later item of the same key in the same write_many chunk replaces it."""
+
+
+@dataclass
+class WriteResult:
+    file: 'File'
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
 class FileDB:
     def __init__(self,
                  index: Index,
-                 storage: Union[DirectTransportStorage, SyncStorage]):
+                 storage: Union[DirectTransportStorage, SyncStorage],
+                 staleness: str = REVALIDATE,
+                 content_addressed: bool = False,
+                 reclaim: str = IMMEDIATE):
+        """With content_addressed, files are stored under SHA256 of their content.
+
+        Identical files are then stored once, and copies only add references in the index.
+        A storage must always be used either content addressed or not. Content addressed
+        files are reclaimed once they are no longer referenced.
+
+        With reclaim=DEFERRED, filedb.gc.collect_deferred has to be run periodically, for
+        example by a cron job, to delete the files deleted or replaced.
+        """
+        if staleness not in (TRUST, REVALIDATE):
+            raise ValueError(f'Unknown staleness policy {staleness}!')
+        if reclaim not in (IMMEDIATE, DEFERRED):
+            raise ValueError(f'Unknown reclaim policy {reclaim}!')
         self.index = index
         self.storage = storage
-
-    def find(self, query: Query) -> List['File']:
-        return [self.file(key) for key in self.index.find(query, self.storage.name)]
+        self.staleness = staleness
+        self.content_addressed = content_addressed
+        self.reclaim = reclaim
+
+    def find(self,
+             query: Query,
+             sort: Optional[Sort] = None,
+             skip: int = 0,
+             limit: int = 0) -> List['File']:
+        return list(self.iter_find(query, sort=sort, skip=skip, limit=limit))
+
+    def iter_find(self,
+                  query: Query,
+                  sort: Optional[Sort] = None,
+                  skip: int = 0,
+                  limit: int = 0,
+                  batch_size: int = 0,
+                  after: Optional[KeyId] = None) -> Iterator['File']:
+        """Lazily yields files matching query, bound to the storage paths found.
+
+        Reading them needs no further index lookups. To resume an interrupted scan, pass
+        key_id of the last file seen as after.
+        """
+        entries = self.index.find_entries(query,
+                                          self.storage.name,
+                                          sort=sort,
+                                          skip=skip,
+                                          limit=limit,
+                                          batch_size=batch_size,
+                                          after=after)
+        for entry in entries:
+            yield File(entry.key,
+                       index=self.index,
+                       storage=self.storage,
+                       storage_path=entry.storage_path,
+                       key_id=entry.key_id,
+                       staleness=self.staleness,
+                       content_addressed=self.content_addressed,
+                       reclaim=self.reclaim)
+
+    def iter_keys(self,
+                  query: Query,
+                  fields: Optional[List[str]] = None,
+                  sort: Optional[Sort] = None,
+                  skip: int = 0,
+                  limit: int = 0,
+                  batch_size: int = 0,
+                  after: Optional[KeyId] = None) -> Iterator[Key]:
+        """Lazily yields keys matching query, with only the given fields if any."""
+        return self.index.find(query,
+                               self.storage.name,
+                               fields=fields,
+                               sort=sort,
+                               skip=skip,
+                               limit=limit,
+                               batch_size=batch_size,
+                               after=after)
+
+    def find_columns(self,
+                     query: Query,
+                     fields: List[str],
+                     categorical: Collection[str] = (),
+                     dataframe: bool = False,
+                     batch_size: int = 0) -> Union[Dict[str, Column], 'pandas.DataFrame']:
+        """Values of fields of keys matching query, as one numpy array per field.
+
+        Returns a pandas DataFrame instead if dataframe is True. See filedb.columns.
+        """
+        keys = self.index.find(query, self.storage.name, fields=fields, batch_size=batch_size)
+        result = columns(keys, fields, categorical)
+        return to_dataframe(result) if dataframe else result
+
+    def count(self, query: Optional[Query] = None) -> int:
+        return self.index.count(query or {}, self.storage.name)
+
+    def distinct(self, field: str, query: Optional[Query] = None) -> List[Value]:
+        return self.index.distinct(field, query or {}, self.storage.name)
+
+    def group_count(self,
+                    fields: List[str],
+                    query: Optional[Query] = None) -> List[Tuple[Tuple[Value, ...], int]]:
+        return self.index.group_count(fields, query or {}, self.storage.name)
+
+    def write_many(self,
+                   items: Iterable[Tuple[Key, Union[bytes, Path]]],
+                   max_workers: int = 8,
+                   chunk_size: int = CHUNK_SIZE) -> List['WriteResult']:
+        """Writes many (key, data) items, data being bytes or path of a file to copy.
+
+        Each chunk of items is stored concurrently, then the index points at the files with
+        bulk writes, which return the files they replace, to be released. Failures are
+        reported per item in the results, which are aligned with items. Of items of the same
+        key within a chunk only the last one is written, the others fail with SupersededError.
+        """
+        results = []
+        with ThreadPoolExecutor(max_workers) as executor:
+            for chunk in chunked(items, chunk_size):
+                files = [File(key,
+                              index=self.index,
+                              storage=self.storage,
+                              staleness=self.staleness,
+                              content_addressed=self.content_addressed,
+                              reclaim=self.reclaim)
+                         for key, _ in chunk]
+                last = {key_hash(file.key): i for i, file in enumerate(files)}
+                errors = []
+                for i, file in enumerate(files):
+                    j = last[key_hash(file.key)]
+                    errors.append(None if j == i else
+                                  SupersededError(f'Replaced by item {len(results) + j}!'))
+                to_write = [i for i, error in enumerate(errors) if error is None]
+
+                stores = [executor.submit(files[i]._stored, chunk[i][1]) for i in to_write]
+                stored = []
+                for i, store in zip(to_write, stores):
+                    try:
+                        stored.append((i, store.result()))
+                    except Exception as e:
+                        errors[i] = e
+
+                items_stored = [(files[i].key, storage_path) for i, storage_path in stored]
+                try:
+                    upserted = self.index.upsert_many(items_stored, self.storage.name, chunk_size)
+                except PyMongoError as e:
+                    # the index may point at them or not, unreferenced ones are left to gc
+                    for i, _ in stored:
+                        errors[i] = e
+                    upserted = []
+
+                points = [executor.submit(files[i]._pointed, storage_path, *result)
+                          for (i, storage_path), result in zip(stored, upserted)]
+                for (i, _), point in zip(stored, points):
+                    try:
+                        point.result()
+                    except Exception as e:
+                        errors[i] = e
+
+                results.extend(WriteResult(file=file, error=error)
+                               for file, error in zip(files, errors))
+        return results
+
+    def read_many(self,
+                  query_or_files: Union[Query, Iterable['File']],
+                  max_workers: int = 8,
+                  max_inflight_bytes: Optional[int] = None,
+                  chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple['File', bytes]]:
+        """Reads files concurrently, yielding (file, data) in the order reads complete.
+
+        Storage paths are resolved in bulk, cache misses are downloaded in parallel. Files
+        given are not modified, unbound ones are yielded as bound copies. See
+        filedb.bulk.read_many for the meaning of max_inflight_bytes.
+        """
+        files = self._files(query_or_files)
+        if files is None:
+            files = self.iter_find(query_or_files, batch_size=chunk_size)
+        else:
+            files = self._bound(files, chunk_size)
+        return bulk.read_many(files, max_workers, max_inflight_bytes)
+
+    def prefetch(self,
+                 query: Query,
+                 max_workers: int = 8,
+                 max_bytes: Optional[int] = None) -> bulk.Prefetch:
+        """Downloads files matching query to cache in the background, skipping cached ones.
+
+        Stops before downloading more than max_bytes, if given. Files can be read meanwhile.
+        """
+        if isinstance(self.storage, SyncStorage):
+            files = self.iter_find(query)
+        else:
+            files = []  # nothing to cache
+        return bulk.Prefetch(files, File._prefetch, max_workers, max_bytes)
+
+    @staticmethod
+    def _files(query_or_files: Union[Query, Iterable['File']]) -> Optional[Iterator['File']]:
+        # queries are dicts or constraints, anything else iterable has to yield files
+        if isinstance(query_or_files, dict) or not isinstance(query_or_files, Iterable):
+            return None
+        files = iter(query_or_files)
+        first = next(files, None)
+        if first is None:
+            return iter([])
+        if not isinstance(first, File):
+            raise TypeError(f'Expected a query or files, got an iterable of {type(first)}!')
+        return itertools.chain([first], files)
+
+    def _bound(self, files: Iterable['File'], chunk_size: int) -> Iterator['File']:
+        for chunk in chunked(files, chunk_size):
+            unbound = [i for i, file in enumerate(chunk) if file._storage_path is None]
+            storage_paths = self.index.storage_paths_many([chunk[i].key for i in unbound],
+                                                          self.storage.name)
+            for i, storage_path in zip(unbound, storage_paths):
+                chunk[i] = copy.copy(chunk[i])
+                chunk[i]._storage_path = storage_path
+            yield from chunk
 
     def file(self, key):
         return File(key,
                     index=self.index,
-                    storage=self.storage)
+                    storage=self.storage,
+                    staleness=self.staleness,
+                    content_addressed=self.content_addressed,
+                    reclaim=self.reclaim)
+
+    def files_many(self, keys: Iterable[Key]) -> List['File']:
+        keys = list(keys)
+        storage_paths = self.index.storage_paths_many(keys, self.storage.name)
+        return [File(key,
+                     index=self.index,
+                     storage=self.storage,
+                     storage_path=storage_path,
+                     staleness=self.staleness,
+                     content_addressed=self.content_addressed,
+                     reclaim=self.reclaim)
+                for key, storage_path in zip(keys, storage_paths)]
+
+
+def _write_data(f: IO, data: Union[bytes, Path]):
+    if isinstance(data, bytes):
+        f.write(data)
+    else:
+        with Path(data).open('rb') as source:
+            shutil.copyfileobj(source, f)
 
 
 class File:
     def __init__(self,
                  key: Key,
                  index: Index,
-                 storage: Union[DirectTransportStorage, SyncStorage]):
+                 storage: Union[DirectTransportStorage, SyncStorage],
+                 storage_path: Optional[str] = None,
+                 key_id: Optional[KeyId] = None,
+                 staleness: str = REVALIDATE,
+                 content_addressed: bool = False,
+                 reclaim: str = IMMEDIATE):
 
         self.key = key
+        self.key_id = key_id
         self.index = index
         self.storage = storage
+        self.staleness = staleness
+        self.content_addressed = content_addressed
+        self.reclaim = reclaim
+        self._storage_path = storage_path
 
     def read_text(self,
                   buffering=-1,
@@ -121,12 +411,18 @@ class File:
                                       'yet implemented!')
 
         to_key = to.key if isinstance(to, File) else to
+        if self.content_addressed:
+            self._reference(to_key)
+            return
+
         storage_path_1 = self.index.storage_path(self.key, self.storage.name)
         if storage_path_1 is None:
             raise FileNotFoundError(f"File({self.key}) does not exist!")
         storage_path_2 = str(uuid.uuid4())
         self.storage.copy(storage_path_1, storage_path_2)
-        self.index.upsert(to_key, storage_path_2, self.storage.name)
+        replaced = self.index.upsert(to_key, storage_path_2, self.storage.name)
+        if replaced is not None:
+            self._release(replaced)
 
     def move(self, to: Union[Key, 'File']):
 
@@ -134,21 +430,30 @@ class File:
             raise NotImplementedError('Moving to a file in a different storage or index is not'
                                       'yet implemented!')
 
+        # storage paths are not derived from keys, so only the index changes
         to_key = to.key if isinstance(to, File) else to
-        storage_path_1 = self.index.storage_path(self.key, self.storage.name)
-        if storage_path_1 is None:
-            raise FileNotFoundError(f"File({self.key}) does not exist!")
-        storage_path_2 = str(uuid.uuid4())
-        self.storage.copy(storage_path_1, storage_path_2)
-        self.index.upsert(to_key, storage_path_2, self.storage.name)
-        self.index.delete(self.key, self.storage.name)
-        self.storage.delete(storage_path_1)
+        if self.content_addressed:
+            if to_key == self.key:
+                return
+            storage_path = self._reference(to_key)
+            # unless rewritten meanwhile
+            if self.index.delete(self.key, self.storage.name, storage_path) is not None:
+                self._release(storage_path)
+        else:
+            storage_path, replaced = self.index.move(self.key, to_key, self.storage.name)
+            if replaced is not None:
+                self._release(replaced)
+        self._storage_path = None
+        if isinstance(to, File):
+            to._storage_path = storage_path
 
     def delete(self):
 
-        storage_path = self.index.storage_path(self.key, self.storage.name)
-        self.index.delete(self.key, self.storage.name)
-        self.storage.delete(storage_path)
+        storage_path = self.index.delete(self.key, self.storage.name)
+        if storage_path is None:
+            raise FileNotFoundError(f"File({self.key}) does not exist!")
+        self._release(storage_path)
+        self._storage_path = None
 
     def exists(self):
 
@@ -174,74 +479,269 @@ class File:
     @contextmanager
     def _read_handle(self, handle_params: _HandleParams):
 
-        storage_path = self.index.storage_path(self.key, self.storage.name)
-        if storage_path is None:
+        bound = self._storage_path is not None
+        storage_path = self._storage_path if bound else self._current_storage_path()
+
+        with ExitStack() as stack:
+            try:
+                f = stack.enter_context(self._storage_read_handle(storage_path, handle_params))
+            except FileNotFoundError:
+                if not bound or self.staleness == TRUST:
+                    raise
+                # bound storage path is stale, file was deleted or rewritten since
+                storage_path = self._current_storage_path()
+                f = stack.enter_context(self._storage_read_handle(storage_path, handle_params))
+            yield f
+
+    def _current_storage_path(self):
+        self._storage_path = self.index.storage_path(self.key, self.storage.name)
+        if self._storage_path is None:
             raise FileNotFoundError(f"File({self.key}) does not exist!")
+        return self._storage_path
 
+    def _prefetch(self, reserve: Optional[Callable[[int], None]] = None) -> Optional[int]:
+        # makes sure a synced file is cached, returns its size if this downloaded it
+        # reserve(size) is called before downloading, see filedb.bulk.Prefetch
+        bound = self._storage_path is not None
+        storage_path = self._storage_path if bound else self._current_storage_path()
+        try:
+            return self._prefetch_storage_path(storage_path, reserve)
+        except FileNotFoundError:
+            if not bound or self.staleness == TRUST:
+                raise
+            # bound storage path is stale, file was deleted or rewritten since
+            return self._prefetch_storage_path(self._current_storage_path(), reserve)
+
+    def _prefetch_storage_path(self, storage_path, reserve) -> Optional[int]:
+        cache = self.storage.cache
+        if cache.is_complete(storage_path, self.storage.name, self.index.name):
+            return None
+        if reserve is not None:
+            reserve(self.storage.size(storage_path))
+
+        sizes = []
+
+        def fetch(path):
+            crc32c = self.storage.download(storage_path, path)
+            sizes.append(path.stat().st_size)
+            return crc32c
+
+        with cache.fetching_path(storage_path=storage_path,
+                                 storage_name=self.storage.name,
+                                 index_name=self.index.name,
+                                 fetch=fetch):
+            pass
+        return sizes[0] if sizes else None
+
+    def _storage_read_handle(self, storage_path, handle_params):
         if isinstance(self.storage, DirectTransportStorage):
-            with self.storage.read_handle(storage_path, **asdict(handle_params)) as f:
-                yield f
+            return self.storage.read_handle(storage_path, **asdict(handle_params))
         else:
-            with self._syncd_read_handle(storage_path=storage_path,
-                                         handle_params=handle_params) as f:
-                yield f
+            return self._syncd_read_handle(storage_path=storage_path,
+                                           handle_params=handle_params)
 
     @contextmanager
     def _syncd_read_handle(self, storage_path, handle_params):
 
-        try:
-            with self.storage.cache.reading_path(storage_path=storage_path,
-                                                 index_name=self.index.name,
-                                                 storage_name=self.storage.name,
-                                                 timeout=None) as path:
+        def fetch(path):
+            return self.storage.download(storage_path, path)
 
-                with path.open(**asdict(handle_params)) as f:
-                    yield f
+        with self.storage.cache.opened(storage_path=storage_path,
+                                       storage_name=self.storage.name,
+                                       index_name=self.index.name,
+                                       fetch=fetch,
+                                       **asdict(handle_params)) as f:
+            yield f
 
-        except cache.FileNotCachedError:
+    @contextmanager
+    def _write_handle(self, handle_params):
 
-            try:
-                with self.storage.cache.writing_path(storage_path=storage_path,
-                                                     index_name=self.index.name,
-                                                     storage_name=self.storage.name,
-                                                     timeout=0) as path:
+        if self.content_addressed:
+            with self._content_write_handle(handle_params, stored=self._point) as f:
+                yield f
+            return
 
-                    self.storage.download(storage_path, path)
+        storage_path = str(uuid.uuid4())
 
-            except lock.FileLocked:
-                with self._syncd_read_handle(storage_path, handle_params) as f:
-                    yield f
+        with self._storage_write_handle(storage_path, handle_params) as f:
+            yield f
 
-            else:
-                with self._syncd_read_handle(storage_path, handle_params) as f:
-                    yield f
-
-    @contextmanager
-    def _write_handle(self, handle_params):
+        self._point(storage_path)
 
+    def _stored(self, data: Union[bytes, Path]) -> str:
+        # stores data without pointing the index to it, returns its (referenced) storage path
+        if self.content_addressed:
+            return self._write_content(data)
         storage_path = str(uuid.uuid4())
+        self._write_storage(storage_path, data)
+        return storage_path
+
+    def _write_storage(self, storage_path, data: Union[bytes, Path]):
+        with self._storage_write_handle(storage_path, _HandleParams(mode='wb')) as f:
+            _write_data(f, data)
 
+    def _write_content(self, data: Union[bytes, Path]) -> str:
+        # stores data without pointing the index to it, returns its referenced storage path
+        storage_paths = []
+        with self._content_write_handle(_HandleParams(mode='wb'),
+                                        stored=storage_paths.append) as f:
+            _write_data(f, data)
+        return storage_paths[0]
+
+    @contextmanager
+    def _content_write_handle(self, handle_params, stored: Callable[[str], None]):
+        # written under a temporary storage path first, as the content is not known yet,
+        # then stored(storage_path) is called with a reference to the stored content
+        staging_path = str(uuid.uuid4())
+        raw_params = _HandleParams(mode='wb', buffering=0)
         if isinstance(self.storage, DirectTransportStorage):
-            with self.storage.write_handle(storage_path, **asdict(handle_params)) as f:
-                yield f
+            staged = self.storage.write_handle(staging_path, **asdict(raw_params))
         else:
-            with self._syncd_write_handle(storage_path, handle_params) as f:
-                yield f
+            staged = self.storage.cache.writing_handle(staging_path,
+                                                       index_name=self.index.name,
+                                                       storage_name=self.storage.name,
+                                                       timeout=None,
+                                                       **asdict(raw_params))
+        try:
+            with staged as raw:
+                f, sha256 = sha256_open(raw, **asdict(handle_params))
+                with f:
+                    yield f
+        except BaseException:
+            self._discard_staged(staging_path)
+            raise
 
-        self.index.upsert(self.key, storage_path, self.storage.name)
+        storage_path = sha256()
+        if isinstance(self.storage, SyncStorage):
+            try:
+                self.storage.cache.move(staging_path,
+                                        storage_path,
+                                        index_name=self.index.name,
+                                        storage_name=self.storage.name)
+            except BaseException:
+                self._discard_staged(staging_path)
+                raise
+
+        if self.index.incref(storage_path, self.storage.name):
+            try:
+                self._store(staging_path, storage_path)
+            except BaseException:
+                self._release(storage_path)
+                raise
+            self.index.stored(storage_path, self.storage.name)
+        elif isinstance(self.storage, DirectTransportStorage):
+            self.storage.delete(staging_path)
+
+        stored(storage_path)
+
+    def _discard_staged(self, staging_path):
+        # removes what a failed content addressed write staged, from storage or the cache
+        if isinstance(self.storage, DirectTransportStorage):
+            try:
+                self.storage.delete(staging_path)
+            except FileNotFoundError:
+                pass
+        else:
+            self.storage.cache.evict(staging_path,
+                                     storage_name=self.storage.name,
+                                     index_name=self.index.name)
 
-    @contextmanager
-    def _syncd_write_handle(self, storage_path, handle_params):
+    def _point(self, storage_path):
+        # points the key at a stored (and referenced, if content addressed) storage path,
+        # releasing the one it replaces, atomically returned by the upsert
+        try:
+            previous = self.index.upsert(self.key, storage_path, self.storage.name)
+        except BaseException:
+            self._release(storage_path)
+            raise
+        self._pointed(storage_path, previous)
+
+    def _pointed(self, storage_path, previous, error=None):
+        # releases the storage path replaced, or the one stored if the index does not point
+        # at it because of the error
+        if error is not None:
+            self._release(storage_path)
+            raise error
+        if previous is not None:
+            # also when rewritten with the same content, it was referenced twice
+            self._release(previous)
+        self._storage_path = storage_path
+
+    def _store(self, staging_path, storage_path):
+        if isinstance(self.storage, DirectTransportStorage):
+            self.storage.move(staging_path, storage_path)
+            return
 
-        with self.storage.cache.writing_path(storage_path,
+        crc32c = self.storage.cache.crc32c(storage_path=storage_path,
+                                           storage_name=self.storage.name,
+                                           index_name=self.index.name)
+        with self.storage.cache.reading_path(storage_path,
                                              index_name=self.index.name,
                                              storage_name=self.storage.name,
                                              timeout=None) as path:
-            with path.open(**asdict(handle_params)) as f:
-                yield f
+            self.storage.upload(path, storage_path, crc32c)
+
+    def _reference(self, to_key) -> str:
+        # points to_key at the content of this file, returns its storage path
+        storage_path = self._current_storage_path()
+        if self.index.incref(storage_path, self.storage.name):
+            # no longer referenced, deleted meanwhile
+            self._release(storage_path)
+            raise FileNotFoundError(f"File({self.key}) does not exist!")
+        File(to_key,
+             index=self.index,
+             storage=self.storage,
+             content_addressed=True)._point(storage_path)
+        return storage_path
+
+    def _release(self, storage_path):
+        # deletes the file from storage or queues it for deletion, if it is no longer referenced
+        if not self.content_addressed:
+            if self.reclaim == DEFERRED:
+                self.index.defer_deletion(storage_path, self.storage.name)
+            else:
+                self.storage.delete(storage_path)
+        elif self.index.decref(storage_path, self.storage.name):
+            # once deleted is called, the content can be referenced again, and is then not
+            # collected from the queue as its refcount is back
+            if self.reclaim == DEFERRED:
+                self.index.defer_deletion(storage_path, self.storage.name)
+            else:
+                try:
+                    self.storage.delete(storage_path)
+                except FileNotFoundError:
+                    pass
+            self.index.deleted(storage_path, self.storage.name)
+        else:
+            return
+
+        if isinstance(self.storage, SyncStorage):
+            self.storage.cache.evict(storage_path,
+                                     storage_name=self.storage.name,
+                                     index_name=self.index.name)
+
+    def _storage_write_handle(self, storage_path, handle_params):
+        # writes the file to storage only, without pointing the index to it
+        if isinstance(self.storage, DirectTransportStorage):
+            return self.storage.write_handle(storage_path, **asdict(handle_params))
+        else:
+            return self._syncd_write_handle(storage_path, handle_params)
+
+    @contextmanager
+    def _syncd_write_handle(self, storage_path, handle_params):
+
+        with self.storage.cache.writing_handle(storage_path,
+                                               index_name=self.index.name,
+                                               storage_name=self.storage.name,
+                                               timeout=None,
+                                               **asdict(handle_params)) as f:
+            yield f
 
         crc32c = self.storage.cache.crc32c(storage_path=storage_path,
                                            storage_name=self.storage.name,
                                            index_name=self.index.name)
-        self.storage.upload(path, storage_path, crc32c)
-        self.index.upsert(self.key, storage_path, self.storage.name)
+        with self.storage.cache.reading_path(storage_path,
+                                             index_name=self.index.name,
+                                             storage_name=self.storage.name,
+                                             timeout=None) as path:
+            self.storage.upload(path, storage_path, crc32c)
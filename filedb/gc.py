@@ -0,0 +1,150 @@
+"""
+Garbage collection of files in storage that no key points at, like the ones left behind by
+crashed writes, or queued for deletion by file databases with DEFERRED reclaim policy.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from dataclasses import dataclass
+from dataclasses import field
+
+from filedb.chunks import chunked
+from filedb.db import FileDB
+from filedb.storage import StoredFile
+from filedb.storage import SyncStorage
+
+GRACE_PERIOD = 24 * 60 * 60
+BATCH_SIZE = 1000
+
+
+@dataclass
+class GarbageReport:
+    dry_run: bool
+    files: int = 0  # in storage
+    referenced: int = 0
+    recent: int = 0  # not referenced, but modified within the grace period
+    garbage: List[str] = field(default_factory=list)  # deleted, or to be deleted if dry run
+    garbage_size: int = 0  # of garbage found in storage, size of queued files is not known
+    errors: List[Tuple[str, Exception]] = field(default_factory=list)
+
+
+def _merged(files: Iterator[StoredFile],
+            storage_paths: Iterator[str]) -> Iterator[Tuple[StoredFile, bool]]:
+    # yields (file, whether it is referenced), both iterators are ordered by storage path
+    storage_path = next(storage_paths, None)
+    for file in files:
+        while storage_path is not None and storage_path < file.storage_path:
+            storage_path = next(storage_paths, None)
+        yield file, storage_path == file.storage_path
+
+
+def _delete(db: FileDB, storage_path: str) -> Optional[Exception]:
+    try:
+        db.storage.delete(storage_path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        return e
+    finally:
+        db.index.deleted(storage_path, db.storage.name)
+    if isinstance(db.storage, SyncStorage):
+        # entries cached by other machines are evicted by their cache cleanup eventually
+        db.storage.cache.evict(storage_path,
+                               storage_name=db.storage.name,
+                               index_name=db.index.name)
+    return None
+
+
+def _delete_batch(db: FileDB,
+                  executor: ThreadPoolExecutor,
+                  storage_paths: List[str],
+                  deferred_before: float,
+                  report: GarbageReport) -> List[str]:
+    # returns storage paths no longer to be deleted, deleted or referenced
+    # keys could have been pointed at some of them since they were found
+    claimed = db.index.claim_deletions(storage_paths, db.storage.name, deferred_before)
+    report.referenced += len(storage_paths) - len(claimed)
+
+    errors = executor.map(lambda storage_path: _delete(db, storage_path), claimed)
+    failed = set()
+    for storage_path, error in zip(claimed, errors):
+        if error is None:
+            report.garbage.append(storage_path)
+        else:
+            report.errors.append((storage_path, error))
+            failed.add(storage_path)
+    return [storage_path for storage_path in storage_paths if storage_path not in failed]
+
+
+def collect_deferred(db: FileDB,
+                     grace_period: float = GRACE_PERIOD,
+                     max_workers: int = 8,
+                     batch_size: int = BATCH_SIZE) -> GarbageReport:
+    """Deletes files queued for deletion more than grace_period seconds ago.
+
+    Unlike collect, does not list the storage.
+    """
+    report = GarbageReport(dry_run=False)
+    deferred_before = time.time() - grace_period
+    storage_paths = db.index.deferred_deletions(db.storage.name, deferred_before, batch_size)
+    with ThreadPoolExecutor(max_workers) as executor:
+        for batch in chunked(storage_paths, batch_size):
+            done = _delete_batch(db, executor, list(dict.fromkeys(batch)), deferred_before,
+                                 report)
+            # queued again since are left for a later collection
+            db.index.remove_deferred_deletions(done, db.storage.name, deferred_before)
+    return report
+
+
+def collect(db: FileDB,
+            grace_period: float = GRACE_PERIOD,
+            dry_run: bool = False,
+            max_workers: int = 8,
+            batch_size: int = BATCH_SIZE) -> GarbageReport:
+    """Deletes files no key points at, last modified more than grace_period seconds ago.
+
+    The storage listing and the storage paths in the index are streamed in order and
+    merged, so memory use does not grow with the number of files. Garbage is deleted in
+    batches of batch_size files, by max_workers threads. With dry_run nothing is deleted,
+    the report lists what would be. The storage must not be shared by other indices.
+
+    Files queued for deletion are deleted first, see collect_deferred. Files queued
+    within the grace period are kept, even if last modified before it.
+    """
+    if dry_run:
+        # queued files are found by the listing anyway
+        report = GarbageReport(dry_run=True)
+    else:
+        report = collect_deferred(db, grace_period, max_workers, batch_size)
+    modified_before = time.time() - grace_period
+    storage_paths = db.index.sorted_storage_paths(db.storage.name, batch_size)
+
+    def garbage():
+        for file, referenced in _merged(db.storage.list(), storage_paths):
+            report.files += 1
+            if referenced:
+                report.referenced += 1
+            elif file.modified > modified_before:
+                report.recent += 1
+            else:
+                yield file
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        for batch in chunked(garbage(), batch_size):
+            if dry_run:
+                report.garbage.extend(file.storage_path for file in batch)
+                report.garbage_size += sum(file.size for file in batch)
+                continue
+
+            garbage_before = len(report.garbage)
+            _delete_batch(db, executor, [file.storage_path for file in batch],
+                          modified_before, report)
+            deleted = set(report.garbage[garbage_before:])
+            report.garbage_size += sum(file.size for file in batch
+                                       if file.storage_path in deleted)
+
+    return report
@@ -1,22 +1,333 @@
 import base64
 import hashlib
+import io
+import time
+import warnings
 from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import IO
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
 
-import crcmod
+import crcmod.predefined
+
+# reflected Castagnoli polynomial
+_CRC32C_POLY = 0x82F63B78
+
+# files are hashed in reads of this size
+BUFFER_SIZE = 4 * 1024 * 1024
+
+_CHECK_VALUE = 0xE3069283  # of b'123456789'
+
+
+class ChecksumError(IOError):
+    pass
 
 
 def md5(path: Path):
     hash_md5 = hashlib.md5()
-    with path.open('rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    with path.open('rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
 
-def crc32c(path: Path):
-    hash_crc32c = crcmod.predefined.Crc('crc-32c')
-    with path.open('rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+# name -> extend(crc, data), CRC32C of data appended to data with CRC32C crc
+_BACKENDS: Dict[str, Callable[[int, bytes], int]] = {}
+_backend: Optional[str] = None
+
+
+def register_backend(name: str, extend: Callable[[int, bytes], int]):
+    """Adds a CRC32C implementation, used if it is faster than the others."""
+    if extend(0, b'123456789') != _CHECK_VALUE:
+        raise ValueError(f'CRC32C backend {name} gives wrong results!')
+    _BACKENDS[name] = extend
+
+
+def backends() -> List[str]:
+    return list(_BACKENDS)
+
+
+def backend() -> str:
+    return _backend
+
+
+def set_backend(name: Optional[str] = None):
+    """Selects CRC32C implementation by name, or the fastest one if name is None."""
+    global _backend
+    if name is None:
+        name = min(_BACKENDS, key=_time_backend)
+    elif name not in _BACKENDS:
+        raise ValueError(f'Unknown CRC32C backend {name}, choose from {backends()}!')
+    _backend = name
+
+
+def _time_backend(name: str) -> float:
+    extend = _BACKENDS[name]
+    data = bytes(range(256)) * 16
+    start = time.perf_counter()
+    extend(0, data)
+    return time.perf_counter() - start
+
+
+def _python_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ _CRC32C_POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_TABLE = _python_table()
+
+
+def _python_extend(crc: int, data: bytes) -> int:
+    crc ^= 0xFFFFFFFF
+    table = _TABLE
+    for byte in memoryview(data).cast('B'):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _crcmod_extend():
+    crc_fun = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
+    return lambda crc, data: crc_fun(data, crc)
+
+
+def _google_crc32c_extend():
+    with warnings.catch_warnings():
+        # falls back to pure python with a warning, timing takes care of that
+        warnings.simplefilter('ignore', RuntimeWarning)
+        import google_crc32c
+
+    # accepts only bytes, not other buffers
+    return lambda crc, data: google_crc32c.extend(
+        crc, data if isinstance(data, bytes) else bytes(data))
+
+
+register_backend('python', _python_extend)
+register_backend('crcmod', _crcmod_extend())
+try:
+    register_backend('google-crc32c', _google_crc32c_extend())
+except ImportError:
+    pass
+set_backend()
+
+
+class Crc32c:
+    """Incremental CRC32C."""
+
+    def __init__(self, backend: Optional[str] = None):
+        self._extend = _BACKENDS[backend or _backend]
+        self.value = 0
+
+    def update(self, data: bytes):
+        self.value = self._extend(self.value, data)
+
+    def base64(self) -> str:
+        return crc32c_base64(self.value)
+
+
+def crc32c_base64(value: int) -> str:
+    # the encoding used by google cloud storage, big endian
+    return base64.b64encode(value.to_bytes(4, 'big')).decode('utf-8')
+
+
+def crc32c_value(crc32c_base64_: str) -> int:
+    return int.from_bytes(base64.b64decode(crc32c_base64_), 'big')
+
+
+def crc32c(path: Path, backend: Optional[str] = None):
+    hash_crc32c = Crc32c(backend)
+    with path.open('rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
             hash_crc32c.update(chunk)
 
-    return base64.encodebytes(hash_crc32c.digest()).rstrip(b'\n').decode('utf-8')
+    return hash_crc32c.base64()
+
+
+def _gf2_times(matrix, vector):
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, matrix[n]) for n in range(32)]
+
+
+def crc32c_combine(crc1: int, crc2: int, length2: int) -> int:
+    """CRC32C of a concatenation, from CRC32Cs of the parts and length of the second one.
+
+    Same algorithm as zlib crc32_combine: crc1 is extended by length2 zero bytes with
+    matrix operators for 1, 2, 4, ... zero bytes, built by repeated squaring.
+    """
+    if length2 == 0:
+        return crc1
+
+    odd = [_CRC32C_POLY] + [1 << n for n in range(31)]  # one zero bit
+    even = _gf2_square(odd)  # two zero bits
+    odd = _gf2_square(even)  # four zero bits
+
+    while True:
+        even = _gf2_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+        odd = _gf2_square(even)
+        if length2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+    return crc1 ^ crc2
+
+
+def crc32c_combine_many(parts: Iterable[Tuple[int, int]]) -> int:
+    """CRC32C of a concatenation, from (crc32c, length) of consecutive parts."""
+    crc = 0
+    for part_crc, length in parts:
+        crc = crc32c_combine(crc, part_crc, length)
+    return crc
+
+
+class _HashingRawWriter(io.RawIOBase):
+    """Raw file computing CRC32C of what is written, None once writes stop being sequential."""
+
+    def __init__(self, raw: io.FileIO):
+        super().__init__()
+        self.raw = raw
+        # appending to an existing file, its start is not hashed
+        self.crc32c = Crc32c() if raw.tell() == 0 else None
+        self.length = 0
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return self.raw.readable()
+
+    def seekable(self):
+        return self.raw.seekable()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def write(self, b):
+        written = self.raw.write(b)
+        if self.crc32c is not None and written:
+            self.crc32c.update(memoryview(b).cast('B')[:written])
+            self.length += written
+        return written
+
+    def readinto(self, b):
+        self.crc32c = None
+        return self.raw.readinto(b)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        position = self.raw.seek(offset, whence)
+        if position != self.length:
+            self.crc32c = None
+        return position
+
+    def tell(self):
+        return self.raw.tell()
+
+    def truncate(self, size=None):
+        self.crc32c = None
+        return self.raw.truncate(size)
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+def _wrap(raw: io.RawIOBase, mode: str, buffering, encoding, errors, newline) -> IO:
+    # buffers and decodes a raw file the way open would
+    if buffering == 0:
+        return raw
+
+    buffer_size = buffering if buffering > 1 else io.DEFAULT_BUFFER_SIZE
+    if '+' in mode:
+        buffer = io.BufferedRandom(raw, buffer_size)
+    else:
+        buffer = io.BufferedWriter(raw, buffer_size)
+    if 'b' in mode:
+        return buffer
+
+    return io.TextIOWrapper(buffer,
+                            encoding=encoding,
+                            errors=errors,
+                            newline=newline,
+                            line_buffering=buffering == 1,
+                            write_through=False)
+
+
+def hashing_open(path: Path,
+                 mode: str = 'wb',
+                 buffering=-1,
+                 encoding=None,
+                 errors=None,
+                 newline=None) -> Tuple[IO, Callable[[], Optional[str]]]:
+    """Opens a new file for writing like open, hashing data on its way to the file.
+
+    Returns the file object and a function that gives CRC32C of the file once it is
+    closed, or None if the file was not written sequentially.
+    """
+    raw = _HashingRawWriter(io.FileIO(str(path), mode.replace('b', '').replace('t', '')))
+
+    def crc32c_():
+        return None if raw.crc32c is None else raw.crc32c.base64()
+
+    return _wrap(raw, mode, buffering, encoding, errors, newline), crc32c_
+
+
+class _Sha256RawWriter(io.RawIOBase):
+    """Raw file passing writes on to a binary file, computing SHA256 of what is written."""
+
+    def __init__(self, f: IO):
+        super().__init__()
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        written = self.f.write(b)
+        if written:
+            self.sha256.update(memoryview(b).cast('B')[:written])
+        return written
+
+
+def sha256_open(f: IO,
+                mode: str = 'wb',
+                buffering=-1,
+                encoding=None,
+                errors=None,
+                newline=None) -> Tuple[IO, Callable[[], str]]:
+    """Wraps a binary file opened for writing, computing SHA256 of the data written to it.
+
+    The wrapper is opened in mode, which must write the file from the start ('w' or
+    'wb'), and buffers like open. Returns it and a function that gives the hex digest once
+    it is closed. Closing the wrapper does not close f.
+    """
+    if mode not in ('w', 'wb', 'wt'):
+        raise ValueError(f'Can only hash files written from start, not opened in {mode} mode!')
+    raw = _Sha256RawWriter(f)
+    return _wrap(raw, mode, buffering, encoding, errors, newline), raw.sha256.hexdigest
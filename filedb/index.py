@@ -1,49 +1,205 @@
+import time
 import uuid
 from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import Union
 
 from bson import ObjectId
+from dataclasses import dataclass
+from pymongo import DeleteOne
+from pymongo import ReplaceOne
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
 from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import WriteError
 
+from filedb.chunks import chunked
 from filedb.key import ID
 from filedb.key import KEY_BYTES
 from filedb.key import Key
+from filedb.key import REPLACED
 from filedb.key import STORAGE_PATH
+from filedb.key import Value
+from filedb.key import bytes_digest
 from filedb.key import key_bytes
+from filedb.key import key_digest
 from filedb.multiprocessing import MultiprocessingMixin
 from filedb.query import expand
 from filedb.query import Query
 
+CHUNK_SIZE = 1000
+
+# documents in storage collections have _id from the key_id collection
+KEY_ID_LAYOUT = 'key_id'
+# documents in storage collections have _id = key_digest(key), no key_id collection
+KEY_DIGEST_LAYOUT = 'key_digest'
+
+_NON_STORAGE_COLLECTIONS = {'key_id', 'settings', 'refcount', 'deferred_deletion'}
+
+# refcount documents, one per stored file of content addressed storages, and per file
+# being deleted by garbage collection
+COUNT = 'count'
+STORED = 'stored'  # set once the file is in storage
+DELETING_SINCE = 'deleting_since'
+DELETING = -1  # count of a file being deleted
+# deletions running for longer are assumed to have crashed
+DELETING_TIMEOUT = 600
+
+# deferred_deletion documents, one per file queued for deletion by garbage collection
+STORAGE_NAME = 'storage_name'
+DEFERRED_AT = 'deferred_at'
+
+KeyId = Union[ObjectId, bytes]
+Sort = List[Tuple[str, int]]
+# storage path replaced by an upsert, or the error if not upserted
+UpsertResult = Tuple[Optional[str], Optional[WriteError]]
+
+
+@dataclass
+class IndexEntry:
+    key_id: KeyId
+    key: Key
+    storage_path: str
+
 
 class Index:
 
     # TODO register key and storage collections for robustness
 
-    def __init__(self, mongo_db: Database):
+    def __init__(self, mongo_db: Database, layout: Optional[str] = None):
         self.mongo_db = mongo_db
         self.key_id_collection = self.mongo_db['key_id']
         self.settings_collection = self.mongo_db['settings']
-        self.key_id_collection.create_index(KEY_BYTES)
+        self.refcount_collection = self.mongo_db['refcount']
+        self.deferred_deletion_collection = self.mongo_db['deferred_deletion']
+
+        if layout not in (None, KEY_ID_LAYOUT, KEY_DIGEST_LAYOUT):
+            raise ValueError(f'Unknown index layout {layout}!')
 
         settings = self.settings_collection.find_one({ID: ObjectId(b'__settings__')})
         if settings and 'index_name' in settings:
             self.name = settings['index_name']
+            # indices created before layouts were introduced have no layout setting
+            self.layout = settings.get('layout', KEY_ID_LAYOUT)
+            if layout is not None and layout != self.layout:
+                raise ValueError(f'Index {self.name} has {self.layout} layout, not {layout}!')
         else:
             self.name = str(uuid.uuid4())
+            self.layout = KEY_ID_LAYOUT if layout is None else layout
             self.settings_collection.update_one(filter={ID: ObjectId(b'__settings__')},
-                                                update={'$set': {'index_name': self.name}},
+                                                update={'$set': {'index_name': self.name,
+                                                                 'layout': self.layout}},
                                                 upsert=True)
 
-    def find(self, query: Query, storage_name: str) -> List[Key]:
+        if self.layout == KEY_ID_LAYOUT:
+            self.key_id_collection.create_index(KEY_BYTES)
+
+    def find_entries(self,
+                     query: Query,
+                     storage_name: str,
+                     fields: Optional[List[str]] = None,
+                     sort: Optional[Sort] = None,
+                     skip: int = 0,
+                     limit: int = 0,
+                     batch_size: int = 0,
+                     after: Optional[KeyId] = None) -> Iterator[IndexEntry]:
+        """Lazily yields entries matching query, fetched from Mongo in batches.
+
+        If fields are given, keys contain only those fields. Unless sorted otherwise,
+        entries come in key_id order, and a scan can be resumed after the last key_id seen.
+        """
         raw_query = expand(query)
+
+        if sort is None:
+            sort = [(ID, 1)]
+
+        if after is not None:
+            if sort != [(ID, 1)]:
+                raise ValueError('Scans resumed with after are sorted by key_id, '
+                                 'can not sort by anything else!')
+            raw_query = {'$and': [raw_query, {ID: {'$gt': after}}]} if raw_query else \
+                {ID: {'$gt': after}}
+
+        projection = None if fields is None else {**{field: True for field in fields},
+                                                  STORAGE_PATH: True}
+
         data_collection = self.mongo_db[storage_name]
-        return data_collection.find(raw_query, {ID: False, STORAGE_PATH: False})
+        cursor = data_collection.find(raw_query,
+                                      projection,
+                                      sort=sort,
+                                      skip=skip,
+                                      limit=limit,
+                                      batch_size=batch_size)
+        for document in cursor:
+            key_id = document.pop(ID)
+            storage_path = document.pop(STORAGE_PATH)
+            document.pop(REPLACED, None)
+            yield IndexEntry(key_id=key_id, key=document, storage_path=storage_path)
+
+    def find(self,
+             query: Query,
+             storage_name: str,
+             fields: Optional[List[str]] = None,
+             sort: Optional[Sort] = None,
+             skip: int = 0,
+             limit: int = 0,
+             batch_size: int = 0,
+             after: Optional[KeyId] = None) -> Iterator[Key]:
+        for entry in self.find_entries(query, storage_name, fields, sort, skip, limit,
+                                       batch_size, after):
+            yield entry.key
+
+    def count(self, query: Query, storage_name: str) -> int:
+        return self.mongo_db[storage_name].count_documents(expand(query))
+
+    def distinct(self, field: str, query: Query, storage_name: str) -> List[Value]:
+        """Distinct values of field among keys matching query, keys without it are skipped.
+
+        As with Mongo's distinct, elements of array values are distinct values themselves.
+        """
+        pipeline = [{'$match': {'$and': [expand(query), {field: {'$exists': True}}]}},
+                    {'$unwind': f'${field}'},
+                    {'$group': {ID: f'${field}'}}]
+        results = self.mongo_db[storage_name].aggregate(pipeline, allowDiskUse=True)
+        return [result[ID] for result in results]
+
+    def group_count(self,
+                    fields: List[str],
+                    query: Query,
+                    storage_name: str) -> List[Tuple[Tuple[Value, ...], int]]:
+        """Counts keys matching query per distinct combination of values of fields.
+
+        Returns (values, count) pairs, values are None for keys without the field.
+        """
+        # fields may contain dots, which are not allowed in _id field names
+        group_id = {f'f{i}': f'${field}' for i, field in enumerate(fields)}
+        pipeline = [{'$match': expand(query)},
+                    {'$group': {ID: group_id, 'count': {'$sum': 1}}}]
+        results = self.mongo_db[storage_name].aggregate(pipeline, allowDiskUse=True)
+        return [(tuple(result[ID].get(f'f{i}') for i in range(len(fields))), result['count'])
+                for result in results]
 
-    def _key_id(self, key: Key) -> Optional[ObjectId]:
+    def _key_id(self, key: Key) -> Optional[KeyId]:
+        if self.layout == KEY_DIGEST_LAYOUT:
+            return key_digest(key)
         result = self.key_id_collection.find_one({KEY_BYTES: key_bytes(key)})
         return None if result is None else result[ID]
 
+    def _key_ids(self, keys: List[Key]) -> List[Optional[KeyId]]:
+        if self.layout == KEY_DIGEST_LAYOUT:
+            return [key_digest(key) for key in keys]
+        keys_bytes = [key_bytes(key) for key in keys]
+        results = self.key_id_collection.find({KEY_BYTES: {'$in': keys_bytes}})
+        key_ids = {result[KEY_BYTES]: result[ID] for result in results}
+        return [key_ids.get(kb) for kb in keys_bytes]
+
     def storage_path(self, key: Key, storage_name: str) -> Optional[str]:
         key_id = self._key_id(key)
         if key_id is None:
@@ -52,72 +208,505 @@ class Index:
         result = data_collection.find_one({ID: key_id})
         return None if result is None else result[STORAGE_PATH]
 
-    def upsert(self,
-               key: Key,
-               storage_path: str,
-               storage_name: str):
+    def storage_paths_many(self,
+                           keys: Iterable[Key],
+                           storage_name: str,
+                           chunk_size: int = CHUNK_SIZE) -> List[Optional[str]]:
+        """Resolves storage paths of many keys, two queries per chunk of keys.
+
+        Returned list is aligned with keys, with None for keys that do not exist.
+        """
+        data_collection = self.mongo_db[storage_name]
+        storage_paths = []
+        for chunk in chunked(keys, chunk_size):
+            key_ids = self._key_ids(chunk)
+            results = data_collection.find({ID: {'$in': [k for k in key_ids if k is not None]}},
+                                           {STORAGE_PATH: True})
+            paths = {result[ID]: result[STORAGE_PATH] for result in results}
+            storage_paths.extend(paths.get(key_id) for key_id in key_ids)
+        return storage_paths
+
+    def _upserted_key_id(self, key: Key) -> KeyId:
+        if self.layout == KEY_DIGEST_LAYOUT:
+            return key_digest(key)
 
         query = {KEY_BYTES: key_bytes(key)}
 
         res = self.key_id_collection.update_one(query, {"$setOnInsert": query}, upsert=True)
 
         if res.upserted_id is not None:
-            key_id = res.upserted_id
+            return res.upserted_id
         else:
-            key_id = self.key_id_collection.find_one(query)[ID]
+            return self.key_id_collection.find_one(query)[ID]
+
+    def upsert(self,
+               key: Key,
+               storage_path: str,
+               storage_name: str) -> Optional[str]:
+        """Points key at storage_path, returns the storage path it pointed at before, if any."""
+        key_id = self._upserted_key_id(key)
+        data_collection = self.mongo_db[storage_name]
+        previous = data_collection.find_one_and_update({ID: key_id},
+                                                       {"$set": {STORAGE_PATH: storage_path},
+                                                        "$setOnInsert": {**key, ID: key_id}},
+                                                       projection={STORAGE_PATH: True},
+                                                       upsert=True)
+        return None if previous is None else previous[STORAGE_PATH]
+
+    def upsert_many(self,
+                    items: Iterable[Tuple[Key, str]],
+                    storage_name: str,
+                    chunk_size: int = CHUNK_SIZE) -> List[UpsertResult]:
+        """Upserts (key, storage_path) items with unordered bulk writes, per chunk of items.
 
+        Returns (replaced, error) pairs aligned with items: the storage path the key pointed
+        at before the item, if any, or the error if the item was not upserted. Items of a
+        key repeated within a chunk replace each other in order. Raises PyMongoError if a
+        chunk fails as a whole, its items may or may not have been upserted then.
+        """
         data_collection = self.mongo_db[storage_name]
-        data_collection.update_one({ID: key_id},
-                                   {"$set": {STORAGE_PATH: storage_path},
-                                    "$setOnInsert": {**key, ID: key_id}},
-                                   upsert=True)
+        results = []
+        for chunk in chunked(items, chunk_size):
+            results.extend(self._upsert_chunk(chunk, data_collection))
+        return results
+
+    def _upsert_chunk(self, chunk, data_collection) -> List[UpsertResult]:
+        keys = [key for key, _ in chunk]
+        results = [(None, None)] * len(chunk)
+
+        if self.layout == KEY_DIGEST_LAYOUT:
+            key_ids = self._key_ids(keys)
+        else:
+            keys_bytes = [key_bytes(key) for key in keys]
+            requests = [UpdateOne({KEY_BYTES: kb}, {'$setOnInsert': {KEY_BYTES: kb}}, upsert=True)
+                        for kb in set(keys_bytes)]
+            try:
+                self.key_id_collection.bulk_write(requests, ordered=False)
+            except BulkWriteError:
+                pass  # keys without key_id are reported below
+            key_ids = self._key_ids(keys)
+            for i, key_id in enumerate(key_ids):
+                if key_id is None:
+                    error = WriteError(f'Could not create key_id of {keys[i]}!', None, None)
+                    results[i] = (None, error)
+
+        # only the last item of a key is written, each other one is replaced by the next
+        first, last = {}, {}
+        for i, key_id in enumerate(key_ids):
+            if key_id is None:
+                continue
+            if key_id in last:
+                results[i] = (chunk[last[key_id]][1], None)
+            else:
+                first[key_id] = i
+            last[key_id] = i
+        if not last:
+            return results
+
+        # each update keeps the storage path it replaced under a token of this chunk, so
+        # that it can be read back even if the key is pointed elsewhere meanwhile
+        token = uuid.uuid4().hex
+        positions = list(last.values())
+        requests = [UpdateOne({ID: key_ids[i]},
+                              [{'$set': {**{field: {'$literal': value}
+                                            for field, value in keys[i].items()},
+                                         STORAGE_PATH: {'$literal': chunk[i][1]},
+                                         f'{REPLACED}.{token}': f'${STORAGE_PATH}'}}],
+                              upsert=True)
+                    for i in positions]
+        failed = set()
+        try:
+            data_collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details['writeErrors']:
+                key_id = key_ids[positions[write_error['index']]]
+                failed.add(key_id)
+                error = WriteError(write_error['errmsg'], write_error['code'], write_error)
+                for i, other_key_id in enumerate(key_ids):
+                    if other_key_id == key_id:
+                        results[i] = (None, error)
+
+        upserted = [key_id for key_id in last if key_id not in failed]
+        replaced = self._replaced_storage_paths(data_collection, upserted, token)
+        for key_id in upserted:
+            results[first[key_id]] = (replaced.get(key_id), None)
+        return results
+
+    @staticmethod
+    def _replaced_storage_paths(data_collection, key_ids, token) -> Dict[KeyId, str]:
+        # reads back and removes storage paths replaced by the updates of token
+        field = f'{REPLACED}.{token}'
+        results = data_collection.find({ID: {'$in': key_ids}}, {field: True})
+        replaced = {result[ID]: result.get(REPLACED, {}).get(token) for result in results}
+        data_collection.update_many({ID: {'$in': key_ids}}, {'$unset': {field: ''}})
+        return {key_id: path for key_id, path in replaced.items() if path is not None}
 
-    def delete(self, key: Key, storage_name: str):
+    def move(self, key: Key, to_key: Key, storage_name: str) -> Tuple[str, Optional[str]]:
+        """Points to_key at the storage path of key and removes key, storage is not touched.
+
+        to_key is updated before key is removed, so the file stays reachable throughout, and
+        key is removed only if it still points at the moved storage path. Returns the moved
+        storage path and the one to_key had before, if any, now referenced by no key.
+        """
         key_id = self._key_id(key)
+        data_collection = self.mongo_db[storage_name]
+        entry = None if key_id is None else data_collection.find_one({ID: key_id},
+                                                                     {STORAGE_PATH: True})
+        if entry is None:
+            raise FileNotFoundError(f'File({key}) does not exist!')
+        storage_path = entry[STORAGE_PATH]
+
+        to_key_id = self._upserted_key_id(to_key)
+        if to_key_id == key_id:
+            return storage_path, None
+
+        previous = data_collection.find_one_and_update({ID: to_key_id},
+                                                       {'$set': {STORAGE_PATH: storage_path},
+                                                        '$setOnInsert': {**to_key, ID: to_key_id}},
+                                                       projection={STORAGE_PATH: True},
+                                                       upsert=True)
+        data_collection.delete_one({ID: key_id, STORAGE_PATH: storage_path})
+
+        if previous is None or previous[STORAGE_PATH] == storage_path:
+            return storage_path, None
+        return storage_path, previous[STORAGE_PATH]
+
+    def delete(self,
+               key: Key,
+               storage_name: str,
+               storage_path: Optional[str] = None) -> Optional[str]:
+        """Removes key, only if it points at storage_path if given.
 
+        Returns the storage path key pointed at, None if nothing was removed.
+        """
+        key_id = self._key_id(key)
         if key_id is None:
-            FileNotFoundError(f'File({key}) does not exist!')
+            return None
+
+        query = {ID: key_id} if storage_path is None else {ID: key_id, STORAGE_PATH: storage_path}
+        deleted = self.mongo_db[storage_name].find_one_and_delete(query,
+                                                                  projection={STORAGE_PATH: True})
+        return None if deleted is None else deleted[STORAGE_PATH]
+
+    @staticmethod
+    def _refcount_id(storage_path: str, storage_name: str):
+        return {'storage_name': storage_name, 'storage_path': storage_path}
+
+    def incref(self, storage_path: str, storage_name: str) -> bool:
+        """Adds a reference to a file, returns True if it might not be in storage yet.
+
+        The caller then has to store the file, and call stored, before pointing a key at
+        it. If the file is being deleted, waits for the deletion to finish.
+        """
+        refcount_id = self._refcount_id(storage_path, storage_name)
+        while True:
+            try:
+                refcount = self.refcount_collection.find_one_and_update(
+                    {ID: refcount_id, COUNT: {'$gte': 0}},
+                    {'$inc': {COUNT: 1}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER)
+                return not refcount.get(STORED, False)
+            except DuplicateKeyError:
+                # being deleted, take over deletions that were abandoned
+                self.refcount_collection.update_one(
+                    {ID: refcount_id,
+                     COUNT: DELETING,
+                     DELETING_SINCE: {'$lt': time.time() - DELETING_TIMEOUT}},
+                    {'$set': {COUNT: 0}, '$unset': {STORED: '', DELETING_SINCE: ''}})
+                time.sleep(0.1)
 
-        self.mongo_db[storage_name].delete_one({ID: key_id})
+    def stored(self, storage_path: str, storage_name: str):
+        self.refcount_collection.update_one({ID: self._refcount_id(storage_path, storage_name)},
+                                            {'$set': {STORED: True}})
+
+    def decref(self, storage_path: str, storage_name: str) -> bool:
+        """Removes a reference to a file, returns True if the caller has to delete it.
+
+        That is if it was the last reference, or the file has no refcount at all. The
+        caller then has to delete the file from storage and call deleted.
+        """
+        refcount_id = self._refcount_id(storage_path, storage_name)
+        refcount = self.refcount_collection.find_one_and_update(
+            {ID: refcount_id, COUNT: {'$gt': 0}},
+            {'$inc': {COUNT: -1}},
+            return_document=ReturnDocument.AFTER)
+        if refcount is None:
+            # not counted, or being deleted by someone else
+            return self.refcount_collection.count_documents({ID: refcount_id}, limit=1) == 0
+        if refcount[COUNT] > 0:
+            return False
+
+        # claim the deletion, unless referenced again meanwhile
+        result = self.refcount_collection.update_one({ID: refcount_id, COUNT: 0},
+                                                     {'$set': {COUNT: DELETING,
+                                                               DELETING_SINCE: time.time()}})
+        return result.modified_count == 1
+
+    def deleted(self, storage_path: str, storage_name: str):
+        self.refcount_collection.delete_one({ID: self._refcount_id(storage_path, storage_name),
+                                             COUNT: DELETING})
+
+    def defer_deletion(self, storage_path: str, storage_name: str):
+        self.deferred_deletion_collection.insert_one({STORAGE_NAME: storage_name,
+                                                      STORAGE_PATH: storage_path,
+                                                      DEFERRED_AT: time.time()})
+
+    def deferred_deletions(self,
+                           storage_name: str,
+                           deferred_before: float,
+                           batch_size: int = 0) -> Iterator[str]:
+        """Yields storage paths of files queued for deletion before deferred_before."""
+        self.deferred_deletion_collection.create_index([(STORAGE_NAME, 1), (DEFERRED_AT, 1)])
+        results = self.deferred_deletion_collection.find({STORAGE_NAME: storage_name,
+                                                          DEFERRED_AT: {'$lt': deferred_before}},
+                                                         {STORAGE_PATH: True},
+                                                         batch_size=batch_size)
+        for result in results:
+            yield result[STORAGE_PATH]
+
+    def remove_deferred_deletions(self,
+                                  storage_paths: List[str],
+                                  storage_name: str,
+                                  deferred_before: float):
+        """Removes files queued for deletion before deferred_before from the queue."""
+        self.deferred_deletion_collection.delete_many({STORAGE_NAME: storage_name,
+                                                       STORAGE_PATH: {'$in': storage_paths},
+                                                       DEFERRED_AT: {'$lt': deferred_before}})
+
+    def sorted_storage_paths(self, storage_name: str, batch_size: int = 0) -> Iterator[str]:
+        """Yields storage paths keys point at, in order, repeated if shared by keys."""
+        data_collection = self.mongo_db[storage_name]
+        data_collection.create_index(STORAGE_PATH)
+        results = data_collection.find({}, {STORAGE_PATH: True, ID: False},
+                                        sort=[(STORAGE_PATH, 1)],
+                                        batch_size=batch_size)
+        for result in results:
+            yield result[STORAGE_PATH]
+
+    def claim_deletions(self,
+                        storage_paths: List[str],
+                        storage_name: str,
+                        deferred_before: Optional[float] = None) -> List[str]:
+        """Claims deletion of files no key points at, returns the storage paths claimed.
+
+        Files with a refcount are skipped, they are referenced or being deleted. So are
+        files queued for deletion since deferred_before, if given. Claimed files can not be
+        referenced again until deleted is called for them.
+        """
+        refcounts = [{ID: self._refcount_id(storage_path, storage_name),
+                      COUNT: DELETING,
+                      DELETING_SINCE: time.time()}
+                     for storage_path in storage_paths]
+        try:
+            self.refcount_collection.insert_many(refcounts, ordered=False)
+            failed = set()
+        except BulkWriteError as e:
+            failed = {write_error['index'] for write_error in e.details['writeErrors']}
+        claimed = [storage_path for i, storage_path in enumerate(storage_paths)
+                   if i not in failed]
+
+        # keys pointed at since the caller looked, or moved to other keys meanwhile
+        results = self.mongo_db[storage_name].find({STORAGE_PATH: {'$in': claimed}},
+                                                   {STORAGE_PATH: True, ID: False})
+        referenced = {result[STORAGE_PATH] for result in results}
+        if deferred_before is not None:
+            results = self.deferred_deletion_collection.find(
+                {STORAGE_NAME: storage_name,
+                 STORAGE_PATH: {'$in': claimed},
+                 DEFERRED_AT: {'$gte': deferred_before}},
+                {STORAGE_PATH: True})
+            referenced.update(result[STORAGE_PATH] for result in results)
+        for storage_path in referenced:
+            self.deleted(storage_path, storage_name)
+        return [storage_path for storage_path in claimed if storage_path not in referenced]
+
+    def _storage_names(self) -> List[str]:
+        return [name for name in self.mongo_db.list_collection_names()
+                if name not in _NON_STORAGE_COLLECTIONS and not name.startswith('system.')]
+
+    def migrate_to_key_digest(self, chunk_size: int = CHUNK_SIZE):
+        """Rewrites an index with key_id layout into key_digest layout.
+
+        No other process may use the index while migrating. If interrupted, it is safe to
+        run again, migration continues where it stopped.
+        """
+        if self.layout == KEY_DIGEST_LAYOUT:
+            return
+
+        for storage_name in self._storage_names():
+            data_collection = self.mongo_db[storage_name]
+            while True:
+                chunk = list(data_collection.find({ID: {'$type': 'objectId'}}, limit=chunk_size))
+                if not chunk:
+                    break
+
+                results = self.key_id_collection.find({ID: {'$in': [doc[ID] for doc in chunk]}})
+                keys_bytes = {result[ID]: result[KEY_BYTES] for result in results}
+
+                requests = []
+                for doc in chunk:
+                    if doc[ID] in keys_bytes:
+                        digest = bytes_digest(keys_bytes[doc[ID]])
+                    else:
+                        digest = key_digest({k: v for k, v in doc.items()
+                                             if k not in (ID, STORAGE_PATH, REPLACED)})
+                    requests.append(ReplaceOne({ID: digest}, {**doc, ID: digest}, upsert=True))
+                    requests.append(DeleteOne({ID: doc[ID]}))
+                data_collection.bulk_write(requests, ordered=True)
+
+        self.settings_collection.update_one(filter={ID: ObjectId(b'__settings__')},
+                                            update={'$set': {'layout': KEY_DIGEST_LAYOUT}})
+        self.layout = KEY_DIGEST_LAYOUT
+        self.key_id_collection.drop()
 
 
 class MPIndex(Index, MultiprocessingMixin):
+    _connection_attributes = ('mongo_db',
+                              'key_id_collection',
+                              'settings_collection',
+                              'refcount_collection',
+                              'deferred_deletion_collection')
 
-    def __init__(self, mongo_db_factory: Callable[[], Database]):
+    def __init__(self,
+                 mongo_db_factory: Callable[[], Database],
+                 layout: Optional[str] = None):
         self.mongo_db_factory = mongo_db_factory
         with self.stay_connected():
-            super().__init__(self.mongo_db)
+            super().__init__(self.mongo_db, layout=layout)
 
     def _setup_connection(self):
         self.mongo_db = self.mongo_db_factory()
         self.key_id_collection = self.mongo_db['key_id']
         self.settings_collection = self.mongo_db['settings']
+        self.refcount_collection = self.mongo_db['refcount']
+        self.deferred_deletion_collection = self.mongo_db['deferred_deletion']
 
     def _teardown_connection(self):
         self.mongo_db.client.close()
         self.mongo_db = None
         self.key_id_collection = None
         self.settings_collection = None
+        self.refcount_collection = None
+        self.deferred_deletion_collection = None
+
+    def find_entries(self,
+                     query: Query,
+                     storage_name: str,
+                     fields: Optional[List[str]] = None,
+                     sort: Optional[Sort] = None,
+                     skip: int = 0,
+                     limit: int = 0,
+                     batch_size: int = 0,
+                     after: Optional[KeyId] = None) -> Iterator[IndexEntry]:
+        with self.stay_connected():
+            yield from super().find_entries(query, storage_name, fields, sort, skip, limit,
+                                            batch_size, after)
 
-    def find(self, query: Query, storage_name: str) -> List[Key]:
+    def count(self, query: Query, storage_name: str) -> int:
         with self.stay_connected():
-            return super().find(query, storage_name)
+            return super().count(query, storage_name)
 
-    def _key_id(self, key: Key) -> Optional[ObjectId]:
+    def distinct(self, field: str, query: Query, storage_name: str) -> List[Value]:
+        with self.stay_connected():
+            return super().distinct(field, query, storage_name)
+
+    def group_count(self,
+                    fields: List[str],
+                    query: Query,
+                    storage_name: str) -> List[Tuple[Tuple[Value, ...], int]]:
+        with self.stay_connected():
+            return super().group_count(fields, query, storage_name)
+
+    def _key_id(self, key: Key) -> Optional[KeyId]:
         with self.stay_connected():
             return super()._key_id(key)
 
+    def _key_ids(self, keys: List[Key]) -> List[Optional[KeyId]]:
+        with self.stay_connected():
+            return super()._key_ids(keys)
+
     def storage_path(self, key: Key, storage_name: str) -> Optional[str]:
         with self.stay_connected():
             return super().storage_path(key, storage_name)
 
+    def storage_paths_many(self,
+                           keys: Iterable[Key],
+                           storage_name: str,
+                           chunk_size: int = CHUNK_SIZE) -> List[Optional[str]]:
+        with self.stay_connected():
+            return super().storage_paths_many(keys, storage_name, chunk_size)
+
     def upsert(self,
                key: Key,
                storage_path: str,
-               storage_name: str):
+               storage_name: str) -> Optional[str]:
         with self.stay_connected():
             return super().upsert(key, storage_path, storage_name)
 
-    def delete(self, key: Key, storage_name: str):
+    def upsert_many(self,
+                    items: Iterable[Tuple[Key, str]],
+                    storage_name: str,
+                    chunk_size: int = CHUNK_SIZE) -> List[UpsertResult]:
+        with self.stay_connected():
+            return super().upsert_many(items, storage_name, chunk_size)
+
+    def move(self, key: Key, to_key: Key, storage_name: str) -> Tuple[str, Optional[str]]:
+        with self.stay_connected():
+            return super().move(key, to_key, storage_name)
+
+    def delete(self,
+               key: Key,
+               storage_name: str,
+               storage_path: Optional[str] = None) -> Optional[str]:
+        with self.stay_connected():
+            return super().delete(key, storage_name, storage_path)
+
+    def incref(self, storage_path: str, storage_name: str) -> bool:
+        with self.stay_connected():
+            return super().incref(storage_path, storage_name)
+
+    def stored(self, storage_path: str, storage_name: str):
+        with self.stay_connected():
+            return super().stored(storage_path, storage_name)
+
+    def decref(self, storage_path: str, storage_name: str) -> bool:
+        with self.stay_connected():
+            return super().decref(storage_path, storage_name)
+
+    def deleted(self, storage_path: str, storage_name: str):
+        with self.stay_connected():
+            return super().deleted(storage_path, storage_name)
+
+    def defer_deletion(self, storage_path: str, storage_name: str):
+        with self.stay_connected():
+            return super().defer_deletion(storage_path, storage_name)
+
+    def deferred_deletions(self,
+                           storage_name: str,
+                           deferred_before: float,
+                           batch_size: int = 0) -> Iterator[str]:
+        with self.stay_connected():
+            yield from super().deferred_deletions(storage_name, deferred_before, batch_size)
+
+    def remove_deferred_deletions(self,
+                                  storage_paths: List[str],
+                                  storage_name: str,
+                                  deferred_before: float):
+        with self.stay_connected():
+            return super().remove_deferred_deletions(storage_paths, storage_name, deferred_before)
+
+    def sorted_storage_paths(self, storage_name: str, batch_size: int = 0) -> Iterator[str]:
+        with self.stay_connected():
+            yield from super().sorted_storage_paths(storage_name, batch_size)
+
+    def claim_deletions(self,
+                        storage_paths: List[str],
+                        storage_name: str,
+                        deferred_before: Optional[float] = None) -> List[str]:
+        with self.stay_connected():
+            return super().claim_deletions(storage_paths, storage_name, deferred_before)
+
+    def migrate_to_key_digest(self, chunk_size: int = CHUNK_SIZE):
         with self.stay_connected():
-            return super().delete(key, storage_name)
+            return super().migrate_to_key_digest(chunk_size)
@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 from typing import Dict
 from typing import List
 from typing import Pattern
@@ -8,6 +9,8 @@ import bson
 
 ID = '_id'
 STORAGE_PATH = '_storage_path_e5c8b4a5-96b1-4ed3-9a36-d8bb28204240'
+# storage paths replaced by bulk upserts, by upsert, until read back
+REPLACED = '_replaced_3f0b9c7e-2d4a-4b8e-9a61-5c7d2e8f1a04'
 KEY_BYTES = 'key_bytes'
 
 Value = Union[None,
@@ -33,6 +36,14 @@ def key_bytes(key: Key):
     return bson.BSON.encode(key_sorted(key))
 
 
+def key_digest(key: Key) -> bytes:
+    return bytes_digest(key_bytes(key))
+
+
+def bytes_digest(key_bytes_: bytes) -> bytes:
+    return hashlib.sha256(key_bytes_).digest()
+
+
 def key_sorted(key: Key):
     if isinstance(key, dict):
         return dict(sorted((k, key_sorted(v)) for k, v in key.items()))
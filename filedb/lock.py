@@ -2,8 +2,11 @@
 Document false positives for read_lock: with timeout = None, it can raise even though it
 was just another writer holding entrance lock
 """
+import abc
+import collections
 import json
 import os
+import threading
 import time
 import uuid
 from contextlib import contextmanager
@@ -13,97 +16,342 @@ import fasteners
 
 from filedb import psutil
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
 
 class FileLocked(Exception):
     def __init__(self, directory):
         super().__init__(f'Cache file {directory} is locked!')
 
 
-class ReaderWriterLock:
+def _deadline(timeout):
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(0., deadline - time.monotonic())
+
+
+class _ProcessLockState:
+    """State of one lock directory, shared by all threads of this process."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = collections.Counter()  # thread ident -> read locks held
+        self.writer = None  # thread ident
+        self.waiting_writers = 0
+        self.users = 0
+
+        # inter-process read lock, held on behalf of all reading threads
+        self.shared_mutex = threading.Lock()
+        self.shared_count = 0
+        self.shared = None
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+# flocks are shared with forked children through inherited descriptors, so a child that
+# does not close them keeps holding the locks of its parent
+_flock_fds = set()
+
+
+def _reset_states():
+    global _states, _states_lock, _flock_fds
+    _states = {}
+    _states_lock = threading.Lock()
+    for fd in _flock_fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    _flock_fds = set()
+
+
+# threads holding locks in the parent do not exist in a forked child
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_states)
+
+
+@contextmanager
+def _process_state(directory: Path):
+    key = os.path.abspath(str(directory))
+    with _states_lock:
+        state = _states.setdefault(key, _ProcessLockState())
+        state.users += 1
+    try:
+        yield state
+    finally:
+        with _states_lock:
+            state.users -= 1
+            if state.users == 0 and _states.get(key) is state:
+                del _states[key]
+
+
+class _LayeredReaderWriterLock(abc.ABC):
+    """Thread level reader writer lock layered under an inter-process one.
+
+    Threads of a process share one inter-process read lock, acquired by the first reading
+    thread and released by the last one. A thread holding a read lock may acquire the
+    write lock, once other threads of the process have released theirs.
+    """
 
     def __init__(self, directory: Path):
-        directory = Path(directory)
-        self.directory = directory
-        self._entrance_lock = fasteners.InterProcessLock(directory / 'entrance_lock')
-        self._write_lock = fasteners.InterProcessLock(directory / 'write_lock')
-        self.my_pid = os.getpid()
-        self.my_pid_create_time = psutil.pid_create_time(self.my_pid)
+        self.directory = Path(directory)
+
+    @abc.abstractmethod
+    def _acquire_shared(self, deadline, max_delay, delay):
+        ...
+
+    @abc.abstractmethod
+    def _release_shared(self, shared):
+        ...
+
+    @abc.abstractmethod
+    def _acquire_exclusive(self, state: _ProcessLockState, deadline, max_delay, delay):
+        ...
+
+    @abc.abstractmethod
+    def _release_exclusive(self, state: _ProcessLockState, exclusive):
+        ...
 
     @contextmanager
     def read_lock(self, timeout=None, max_delay=0.1, delay=0.01):
+        deadline = _deadline(timeout)
+        me = threading.get_ident()
 
-        got = self._entrance_lock.acquire(blocking=timeout != 0,
-                                          delay=delay,
-                                          max_delay=max_delay,
-                                          timeout=timeout)
-        if not got:
-            raise FileLocked(self.directory)
+        with _process_state(self.directory) as state:
 
-        got = self._write_lock.acquire(blocking=timeout != 0,
-                                       delay=delay,
-                                       max_delay=max_delay,
-                                       timeout=timeout)
-        if not got:
-            raise FileLocked(self.directory)
+            with state.condition:
+                got = state.condition.wait_for(
+                    lambda: (state.writer is None and
+                             (not state.waiting_writers or state.readers[me] > 0)),
+                    _remaining(deadline))
+                if not got:
+                    raise FileLocked(self.directory)
+                state.readers[me] += 1
 
-        self._write_lock.release()
+            try:
+                self._share(state, deadline, max_delay, delay)
+                try:
+                    yield
+                finally:
+                    self._unshare(state)
+            finally:
+                with state.condition:
+                    state.readers[me] -= 1
+                    if not state.readers[me]:
+                        del state.readers[me]
+                    state.condition.notify_all()
 
-        flag = Flag(directory=self.directory,
-                    pid=self.my_pid,
-                    pid_create_time=self.my_pid_create_time)
-        flag.plant()
-        self._entrance_lock.release()
+    def _share(self, state: _ProcessLockState, deadline, max_delay, delay):
+        remaining = _remaining(deadline)
+        if not state.shared_mutex.acquire(timeout=-1 if remaining is None else remaining):
+            raise FileLocked(self.directory)
         try:
-            yield
+            if state.shared_count == 0:
+                state.shared = self._acquire_shared(deadline, max_delay, delay)
+            state.shared_count += 1
         finally:
-            flag.remove()
+            state.shared_mutex.release()
+
+    def _unshare(self, state: _ProcessLockState):
+        with state.shared_mutex:
+            state.shared_count -= 1
+            if state.shared_count == 0:
+                self._release_shared(state.shared)
+                state.shared = None
 
     @contextmanager
     def write_lock(self, timeout=None, max_delay=0.1, delay=0.01):
-        got = self._entrance_lock.acquire(blocking=timeout != 0,
-                                          delay=delay,
-                                          max_delay=max_delay,
-                                          timeout=timeout)
-        if not got:
-            raise FileLocked(self.directory)
+        deadline = _deadline(timeout)
+        me = threading.get_ident()
+
+        with _process_state(self.directory) as state:
+
+            with state.condition:
+                state.waiting_writers += 1
+                try:
+                    got = state.condition.wait_for(
+                        lambda: (state.writer is None and
+                                 all(reader == me for reader in state.readers)),
+                        _remaining(deadline))
+                finally:
+                    state.waiting_writers -= 1
+                if not got:
+                    state.condition.notify_all()
+                    raise FileLocked(self.directory)
+                state.writer = me
 
-        got = self._write_lock.acquire(blocking=timeout != 0,
-                                       delay=delay,
-                                       max_delay=max_delay,
-                                       timeout=timeout)
+            try:
+                exclusive = self._acquire_exclusive(state, deadline, max_delay, delay)
+                try:
+                    yield
+                finally:
+                    self._release_exclusive(state, exclusive)
+            finally:
+                with state.condition:
+                    state.writer = None
+                    state.condition.notify_all()
+
+
+class ReaderWriterLock(_LayeredReaderWriterLock):
+
+    def __init__(self, directory: Path):
+        super().__init__(directory)
+        self._entrance_lock = fasteners.InterProcessLock(self.directory / 'entrance_lock')
+        self._write_lock = fasteners.InterProcessLock(self.directory / 'write_lock')
+        self.my_pid = os.getpid()
+        self.my_pid_create_time = psutil.pid_create_time(self.my_pid)
+
+    def _acquire(self, lock, deadline, max_delay, delay):
+        timeout = _remaining(deadline)
+        got = lock.acquire(blocking=timeout != 0,
+                           delay=delay,
+                           max_delay=max_delay,
+                           timeout=timeout)
         if not got:
             raise FileLocked(self.directory)
 
+    def _acquire_shared(self, deadline, max_delay, delay):
+        self._acquire(self._entrance_lock, deadline, max_delay, delay)
+        try:
+            self._acquire(self._write_lock, deadline, max_delay, delay)
+            self._write_lock.release()
+
+            flag = Flag(directory=self.directory,
+                        pid=self.my_pid,
+                        pid_create_time=self.my_pid_create_time)
+            flag.plant()
+        finally:
+            self._entrance_lock.release()
+        return flag
+
+    def _release_shared(self, flag: 'Flag'):
+        flag.remove()
+
+    def _acquire_exclusive(self, state, deadline, max_delay, delay):
+        self._acquire(self._entrance_lock, deadline, max_delay, delay)
+        try:
+            self._acquire(self._write_lock, deadline, max_delay, delay)
+            try:
+                self._wait_for_readers(deadline, max_delay, delay)
+            except BaseException:
+                self._write_lock.release()
+                raise
+        finally:
+            self._entrance_lock.release()
+
+    def _release_exclusive(self, state, exclusive):
+        self._write_lock.release()
+
+    def _wait_for_readers(self, deadline, max_delay, delay):
         for existing_flag in Flag.planted_flags(self.directory):
 
-            # my own flag
+            # my own flag, the only thread of this process reading is the one acquiring
             if existing_flag.pid == self.my_pid and \
                     existing_flag.pid_create_time == self.my_pid_create_time:
                 continue
 
+            sleep_time = delay
+            while existing_flag.is_planted() and not existing_flag.is_stale():
+                remaining = _remaining(deadline)
+                if remaining == 0:
+                    raise FileLocked(self.directory)
+                time.sleep(sleep_time if remaining is None else min(sleep_time, remaining))
+                sleep_time = min(max_delay, sleep_time + delay)
+
             # stale flag
-            if existing_flag.is_stale():
+            if existing_flag.is_planted():
                 existing_flag.remove()
-                continue
 
-            # otherwise
-            if timeout == 0:
-                raise FileLocked(self.directory)
-            else:
-                waited = 0
-                sleep_time = delay
-                while (existing_flag.is_planted() and
-                       not existing_flag.is_stale() and
-                       (timeout is None or waited < timeout)):
-                    time.sleep(sleep_time)
-                    waited += sleep_time
-                    sleep_time = min(max_delay, sleep_time + delay)
-
-        self._entrance_lock.release()
+
+class FlockReaderWriterLock(_LayeredReaderWriterLock):
+    """Reader writer lock on kernel flock locks, for POSIX systems only.
+
+    Has the same interface as ReaderWriterLock, but there are no flag files and no polling
+    (except for waiting with a finite timeout). Locks are released by the kernel when the
+    process dies. Writers hold the entrance lock while waiting for readers to finish, so
+    new readers queue up behind them.
+
+    Does not exclude ReaderWriterLock on the same directory, all processes sharing a
+    directory must use the same kind of lock.
+    """
+
+    def __init__(self, directory: Path):
+        if fcntl is None:
+            raise NotImplementedError('FlockReaderWriterLock is not supported on this platform!')
+        super().__init__(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._entrance_path = self.directory / 'entrance_flock'
+        self._rw_path = self.directory / 'rw_flock'
+
+    def _flock(self, fd, operation, deadline, max_delay, delay):
+        if deadline is None:
+            fcntl.flock(fd, operation)
+            return
+
+        sleep_time = delay
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                remaining = _remaining(deadline)
+                if remaining == 0:
+                    raise FileLocked(self.directory)
+                time.sleep(min(sleep_time, remaining))
+                sleep_time = min(max_delay, sleep_time + delay)
+
+    def _open_locked(self, path, operation, deadline, max_delay, delay):
+        fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o666)
+        _flock_fds.add(fd)
         try:
-            yield
+            self._flock(fd, operation, deadline, max_delay, delay)
+        except BaseException:
+            self._close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def _close(fd):
+        _flock_fds.discard(fd)
+        os.close(fd)
+
+    def _acquire_shared(self, deadline, max_delay, delay):
+        entrance_fd = self._open_locked(self._entrance_path, fcntl.LOCK_EX, deadline,
+                                        max_delay, delay)
+        try:
+            return self._open_locked(self._rw_path, fcntl.LOCK_SH, deadline, max_delay, delay)
         finally:
-            self._write_lock.release()
+            self._close(entrance_fd)
+
+    def _release_shared(self, fd):
+        self._close(fd)
+
+    def _acquire_exclusive(self, state, deadline, max_delay, delay):
+        entrance_fd = self._open_locked(self._entrance_path, fcntl.LOCK_EX, deadline,
+                                        max_delay, delay)
+        try:
+            if state.shared is None:
+                return self._open_locked(self._rw_path, fcntl.LOCK_EX, deadline,
+                                         max_delay, delay)
+
+            # the only thread of this process reading is the one acquiring, so the shared
+            # lock of the process is converted (flock conversions are not atomic)
+            self._flock(state.shared, fcntl.LOCK_EX, deadline, max_delay, delay)
+            return None
+        finally:
+            self._close(entrance_fd)
+
+    def _release_exclusive(self, state, fd):
+        if fd is None:
+            fcntl.flock(state.shared, fcntl.LOCK_SH)
+        else:
+            self._close(fd)
 
 
 class Flag:
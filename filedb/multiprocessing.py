@@ -1,9 +1,42 @@
 import abc
+import atexit
+import os
+import threading
+import weakref
 from contextlib import contextmanager
 
+_connect_lock = threading.Lock()
+
+# instances connected in this process, weakly referenced so that they can still be collected
+_connected = weakref.WeakSet()
+
+
+def _reset_connect_lock():
+    global _connect_lock
+    _connect_lock = threading.Lock()
+
+
+# a fork while some thread holds the lock would leave it locked forever in the child
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_connect_lock)
+
+
+@atexit.register
+def _disconnect_all_at_exit():
+    for instance in list(_connected):
+        instance._disconnect_at_exit()
+
 
 class MultiprocessingMixin:
-    _connected = False
+    """Keeps one connection per process, shared by all threads of that process.
+
+    Connection is set up lazily on first use, set up again in forked or unpickled copies
+    (as clients are not fork safe and can not be pickled) and torn down at exit.
+    """
+    _connected_pid = None
+
+    # attributes holding the connection, not to be pickled
+    _connection_attributes = ()
 
     @abc.abstractmethod
     def _setup_connection(self):
@@ -15,21 +48,30 @@ class MultiprocessingMixin:
 
     @contextmanager
     def stay_connected(self):
-        if not self._connected:
-            self._setup_connection()
-            self._connected = True
-            try:
-                yield
-            finally:
-                self._teardown_connection()
-                self._connected = False
-        else:
-            yield
+        if self._connected_pid != os.getpid():
+            with _connect_lock:
+                if self._connected_pid != os.getpid():
+                    self.connect()
+        yield
 
     def connect(self):
         self._setup_connection()
-        self._connected = True
+        self._connected_pid = os.getpid()
+        _connected.add(self)
 
     def disconnect(self):
-        self._teardown_connection()
-        self._connected = False
+        if self._connected_pid == os.getpid():
+            self._teardown_connection()
+        self._connected_pid = None
+        _connected.discard(self)
+
+    def _disconnect_at_exit(self):
+        # instances connected by a parent process are inherited by forked children
+        if self._connected_pid == os.getpid():
+            self.disconnect()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attribute in self._connection_attributes + ('_connected_pid',):
+            state.pop(attribute, None)
+        return state
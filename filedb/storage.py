@@ -1,20 +1,59 @@
+import os
 import shutil
+import threading
+import uuid
 from abc import ABC
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 from typing import Any
 from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 from typing import Union
 
 # TODO these should be optional if using S3
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 from google.cloud.storage import Bucket
+from dataclasses import dataclass
+from dataclasses import field
 
 from filedb.cache import Cache
+from filedb.chunks import chunked
+from filedb.hash import ChecksumError
+from filedb.hash import Crc32c
 from filedb.hash import crc32c
+from filedb.hash import crc32c_base64
+from filedb.hash import crc32c_combine_many
+from filedb.hash import crc32c_value
+from filedb.hash import hashing_open
 from filedb.multiprocessing import MultiprocessingMixin
 
+PART_SIZE = 64 * 2 ** 20
+MAX_CONCURRENCY = 8
+_BLOCK_SIZE = 8 * 2 ** 20
+_MAX_COMPOSE = 32
+_S3_MIN_PART_SIZE = 5 * 2 ** 20
+_S3_MAX_PARTS = 10000
+
+# when files written to local storage are fsynced: never (left to the operating system, a crash
+# can lose or truncate files the index already points at), by each write, or by one write for
+# all the writes waiting meanwhile
+NO_FSYNC = 'none'
+FSYNC = 'fsync'
+GROUP_FSYNC = 'group'
+
+
+@dataclass
+class StoredFile:
+    storage_path: str
+    size: int
+    modified: float  # timestamp
+
 
 class Storage(ABC):
 
@@ -29,6 +68,14 @@ class Storage(ABC):
     def delete(self, storage_path):
         pass
 
+    def move(self, storage_path_1, storage_path_2):
+        self.copy(storage_path_1, storage_path_2)
+        self.delete(storage_path_1)
+
+    def list(self) -> Iterator[StoredFile]:
+        """Yields all files in storage, ordered by storage path."""
+        raise NotImplementedError(f'Listing {type(self).__name__} is not implemented!')
+
     @abstractmethod
     def crc32c(self, storage_path):
         pass
@@ -63,15 +110,138 @@ class SyncStorage(Storage):
         self.cache = cache
         super().__init__(name=name)
 
+    # returns crc32c of the downloaded file, or None if it was not computed
     @abstractmethod
     def download(self, storage_path, cache_path):
         pass
 
+    def size(self, storage_path) -> int:
+        raise NotImplementedError(f'Size of files in {type(self).__name__} is not implemented!')
+
     @abstractmethod
     def upload(self, cache_path, storage_path, file_hash):
         pass
 
 
+def _pwrite(fd, data, offset, lock):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:  # windows
+            with lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def _pread(fd, size, offset, lock):
+    chunks = []
+    while size:
+        if hasattr(os, 'pread'):
+            chunk = os.pread(fd, size, offset)
+        else:  # windows
+            with lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                chunk = os.read(fd, size)
+        if not chunk:
+            raise IOError(f'Unexpected end of file at {offset}!')
+        chunks.append(chunk)
+        size -= len(chunk)
+        offset += len(chunk)
+    return b''.join(chunks)
+
+
+def _preallocate(fd, size):
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # not supported by the file system
+    os.ftruncate(fd, size)
+
+
+class _PartWriter:
+    """File like object writing one part of a file at its offset, hashing what it writes."""
+
+    def __init__(self, fd, offset, lock):
+        self.fd = fd
+        self.offset = offset
+        self.lock = lock
+        self.length = 0
+        self.crc32c = Crc32c()
+
+    def write(self, data):
+        _pwrite(self.fd, data, self.offset + self.length, self.lock)
+        self.crc32c.update(data)
+        self.length += len(data)
+        return len(data)
+
+
+def _download_parts(cache_path,
+                    size: int,
+                    part_size: int,
+                    max_concurrency: int,
+                    download_part: Callable[[int, int, _PartWriter], None]) -> int:
+    """Calls download_part(start, end, writer) concurrently for parts of a file of size.
+
+    Parts are written into a preallocated file at their offsets. Returns CRC32C of the
+    file, combined from CRC32Cs of the parts.
+    """
+    with open(str(cache_path), 'wb') as f:
+        fd = f.fileno()
+        lock = threading.Lock()
+        _preallocate(fd, size)
+
+        def part(start):
+            end = min(start + part_size, size)
+            writer = _PartWriter(fd, start, lock)
+            download_part(start, end, writer)
+            if writer.length != end - start:
+                raise IOError(f'Expected {end - start} bytes at {start} of {cache_path}, '
+                              f'got {writer.length}!')
+            return writer.crc32c.value, writer.length
+
+        with ThreadPoolExecutor(max_concurrency) as executor:
+            parts = list(executor.map(part, range(0, size, part_size)))
+
+    return crc32c_combine_many(parts)
+
+
+def _upload_parts(cache_path,
+                  part_size: int,
+                  max_concurrency: int,
+                  upload_part: Callable[[int, bytes, str], Any]) -> Tuple[List[Any], int]:
+    """Calls upload_part(number, data, crc32c) concurrently for parts of a file, from 0.
+
+    Each part is read from the file into memory by the thread uploading it. Returns what
+    upload_part returned for each part, and CRC32C of the file combined from the parts.
+    """
+    size = os.path.getsize(str(cache_path))
+    with open(str(cache_path), 'rb') as f:
+        fd = f.fileno()
+        lock = threading.Lock()
+
+        def part(number_start):
+            number, start = number_start
+            data = _pread(fd, min(part_size, size - start), start, lock)
+            crc = Crc32c()
+            crc.update(data)
+            return upload_part(number, data, crc.base64()), (crc.value, len(data))
+
+        with ThreadPoolExecutor(max_concurrency) as executor:
+            results = list(executor.map(part, enumerate(range(0, size, part_size))))
+
+    return [result for result, _ in results], crc32c_combine_many(crc for _, crc in results)
+
+
+def _verify_crc32c(value: int, expected: Optional[str], uri: str):
+    if expected is not None and value != crc32c_value(expected):
+        raise ChecksumError(f'{uri} has crc32c {crc32c_base64(value)}, not {expected}!')
+
+
 # TODO store keys also
 class GoogleCloudStorage(SyncStorage):
 
@@ -79,9 +249,13 @@ class GoogleCloudStorage(SyncStorage):
                  bucket: Union[str, Bucket],
                  prefix: str = '',
                  delimiter: str = '/',
-                 cache: Cache = Cache()):
+                 cache: Cache = Cache(),
+                 part_size: int = PART_SIZE,
+                 max_concurrency: int = MAX_CONCURRENCY):
         self.prefix = prefix
         self.delimiter = delimiter
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
 
         if isinstance(bucket, str):
             self.bucket = storage.Client().get_bucket(bucket)
@@ -104,31 +278,102 @@ class GoogleCloudStorage(SyncStorage):
     def delete(self, storage_path):
         self.bucket.blob(self._bucket_path(storage_path)).delete()
 
+    def list(self) -> Iterator[StoredFile]:
+        # listed in lexicographic order of names
+        prefix = self._bucket_path('')
+        for blob in self.bucket.list_blobs(prefix=prefix, delimiter=self.delimiter):
+            yield StoredFile(storage_path=blob.name[len(prefix):],
+                             size=blob.size,
+                             modified=blob.updated.timestamp())
+
     def download(self, storage_path, cache_path):
-        self.bucket.blob(self._bucket_path(storage_path)).download_to_filename(cache_path)
+        uri = f'{self.gs_uri}{storage_path}'
+        blob = self.bucket.get_blob(self._bucket_path(storage_path))
+        if blob is None:
+            raise FileNotFoundError(f'{uri} does not exist!')
+
+        def download_part(start, end, writer):
+            try:
+                blob.download_to_file(writer, start=start, end=end - 1, checksum=None)
+            except NotFound:
+                raise FileNotFoundError(f'{uri} does not exist!')
+
+        value = _download_parts(cache_path, blob.size, self.part_size, self.max_concurrency,
+                                download_part)
+        _verify_crc32c(value, blob.crc32c, uri)
+        return crc32c_base64(value)
 
     def upload(self, cache_path, storage_path, file_hash):
         blob = self.bucket.blob(self._bucket_path(storage_path))
-        blob.crc32c = file_hash
-        blob.upload_from_filename(str(cache_path))
+        if os.path.getsize(str(cache_path)) <= self.part_size:
+            blob.crc32c = file_hash
+            blob.upload_from_filename(str(cache_path))
+            return
+
+        # parts are uploaded as temporary objects and composed, at most 32 at a time
+        temporary = []
+
+        def upload_part(number, data, part_hash):
+            part_blob = self.bucket.blob(f'{blob.name}.part-{number}')
+            part_blob.crc32c = part_hash
+            temporary.append(part_blob)
+            part_blob.upload_from_string(data)
+            return part_blob
+
+        try:
+            blobs, value = _upload_parts(cache_path, self.part_size, self.max_concurrency,
+                                         upload_part)
+            _verify_crc32c(value, file_hash, cache_path)
+
+            level = 0
+            with ThreadPoolExecutor(self.max_concurrency) as executor:
+                while len(blobs) > _MAX_COMPOSE:
+                    groups = list(chunked(blobs, _MAX_COMPOSE))
+                    composed = [self.bucket.blob(f'{blob.name}.compose-{level}-{i}')
+                                for i in range(len(groups))]
+                    temporary.extend(composed)
+                    list(executor.map(lambda c, g: c.compose(g), composed, groups))
+                    blobs = composed
+                    level += 1
+            blob.compose(blobs)
+        finally:
+            for temporary_blob in temporary:
+                try:
+                    temporary_blob.delete()
+                except NotFound:
+                    pass
+
+        # composed by GCS from the parts, so this checks the parts arrived intact
+        _verify_crc32c(crc32c_value(blob.crc32c), file_hash, f'{self.gs_uri}{storage_path}')
 
     def crc32c(self, storage_path):
         return self.bucket.blob(self._bucket_path(storage_path)).crc32c
 
+    def size(self, storage_path) -> int:
+        blob = self.bucket.get_blob(self._bucket_path(storage_path))
+        if blob is None:
+            raise FileNotFoundError(f'{self.gs_uri}{storage_path} does not exist!')
+        return blob.size
+
 
 class MPGoogleCloudStorage(GoogleCloudStorage, MultiprocessingMixin):
+    _connection_attributes = ('bucket',)
 
     def __init__(self,
                  bucket_factory: Callable[[], Bucket],
                  prefix: str = '',
                  delimiter: str = '/',
-                 cache: Cache = Cache()):
+                 cache: Cache = Cache(),
+                 part_size: int = PART_SIZE,
+                 max_concurrency: int = MAX_CONCURRENCY):
         self.bucket_factory = bucket_factory
         with self.stay_connected():
             super().__init__(bucket=self.bucket,
                              cache=cache,
                              prefix=prefix,
-                             delimiter=delimiter)
+                             delimiter=delimiter,
+                             part_size=part_size,
+                             max_concurrency=max_concurrency)
 
     def _setup_connection(self):
         self.bucket = self.bucket_factory()
@@ -144,9 +389,13 @@ class MPGoogleCloudStorage(GoogleCloudStorage, MultiprocessingMixin):
         with self.stay_connected():
             super().delete(storage_path)
 
+    def list(self) -> Iterator[StoredFile]:
+        with self.stay_connected():
+            yield from super().list()
+
     def download(self, storage_path, cache_path):
         with self.stay_connected():
-            super().download(storage_path, cache_path)
+            return super().download(storage_path, cache_path)
 
     def upload(self, cache_path, storage_path, file_hash):
         with self.stay_connected():
@@ -156,6 +405,10 @@ class MPGoogleCloudStorage(GoogleCloudStorage, MultiprocessingMixin):
         with self.stay_connected():
             return super().crc32c(storage_path)
 
+    def size(self, storage_path) -> int:
+        with self.stay_connected():
+            return super().size(storage_path)
+
 
 # boto3 classes are created during runtime, so we can't use them for type annotations
 # Thus, this annotation is for humans only
@@ -169,9 +422,13 @@ class S3(SyncStorage):
                  bucket: Union[str, S3Bucket],
                  prefix: str = '',
                  delimiter: str = '/',
-                 cache: Cache = Cache()):
+                 cache: Cache = Cache(),
+                 part_size: int = PART_SIZE,
+                 max_concurrency: int = MAX_CONCURRENCY):
         self.prefix = prefix
         self.delimiter = delimiter
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
         self.bucket = bucket
 
         if isinstance(bucket, str):
@@ -196,33 +453,127 @@ class S3(SyncStorage):
     def delete(self, storage_path):
         self.bucket.Object(key=self._bucket_path(storage_path)).delete()
 
+    def list(self) -> Iterator[StoredFile]:
+        # listed in order of UTF-8 encoded keys, the same as of storage paths
+        prefix = self._bucket_path('')
+        for summary in self.bucket.objects.filter(Prefix=prefix, Delimiter=self.delimiter):
+            yield StoredFile(storage_path=summary.key[len(prefix):],
+                             size=summary.size,
+                             modified=summary.last_modified.timestamp())
+
     def download(self, storage_path, cache_path):
-        self.bucket.download_file(Key=self._bucket_path(storage_path),
-                                  Filename=str(cache_path))
+        from botocore.exceptions import ClientError
+
+        uri = f'{self.s3_uri}{storage_path}'
+        client = self.bucket.meta.client
+
+        def get_object(**kwargs):
+            try:
+                return client.get_object(Bucket=self.bucket.name,
+                                         Key=self._bucket_path(storage_path),
+                                         **kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    raise FileNotFoundError(f'{uri} does not exist!')
+                raise
+
+        # the first part tells the size, so small objects take one request
+        try:
+            first = get_object(Range=f'bytes=0-{self.part_size - 1}')
+            size = int(first['ContentRange'].split('/')[-1])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            first = get_object()  # empty objects have no ranges
+            size = first['ContentLength']
+
+        def download_part(start, end, writer):
+            if start == 0:
+                body = first['Body']
+            else:
+                body = get_object(Range=f'bytes={start}-{end - 1}', IfMatch=first['ETag'])['Body']
+            for block in iter(lambda: body.read(_BLOCK_SIZE), b''):
+                writer.write(block)
+
+        value = _download_parts(cache_path, size, self.part_size, self.max_concurrency,
+                                download_part)
+        _verify_crc32c(value, first['Metadata'].get('crc32c'), uri)
+        return crc32c_base64(value)
 
     def upload(self, cache_path, storage_path, file_hash):
-        self.bucket.upload_file(Filename=str(cache_path),
-                                Key=self._bucket_path(storage_path),
-                                ExtraArgs={"Metadata": {"crc32c": file_hash}})
+        client = self.bucket.meta.client
+        key = self._bucket_path(storage_path)
+        size = os.path.getsize(str(cache_path))
+        # S3 allows at most 10000 parts, of at least 5 MiB except the last one
+        part_size = max(self.part_size, _S3_MIN_PART_SIZE, -(-size // _S3_MAX_PARTS))
+
+        if size <= part_size:
+            with open(str(cache_path), 'rb') as f:
+                client.put_object(Bucket=self.bucket.name,
+                                  Key=key,
+                                  Body=f,
+                                  Metadata={'crc32c': file_hash})
+            return
+
+        upload_id = client.create_multipart_upload(Bucket=self.bucket.name,
+                                                   Key=key,
+                                                   Metadata={'crc32c': file_hash})['UploadId']
+
+        def upload_part(number, data, part_hash):
+            response = client.upload_part(Bucket=self.bucket.name,
+                                          Key=key,
+                                          UploadId=upload_id,
+                                          PartNumber=number + 1,
+                                          Body=data)
+            return {'ETag': response['ETag'], 'PartNumber': number + 1}
+
+        try:
+            parts, value = _upload_parts(cache_path, part_size, self.max_concurrency,
+                                         upload_part)
+            _verify_crc32c(value, file_hash, cache_path)
+            client.complete_multipart_upload(Bucket=self.bucket.name,
+                                             Key=key,
+                                             UploadId=upload_id,
+                                             MultipartUpload={'Parts': parts})
+        except BaseException:
+            client.abort_multipart_upload(Bucket=self.bucket.name, Key=key, UploadId=upload_id)
+            raise
 
     def crc32c(self, storage_path):
         return self.bucket.Object(key=self._bucket_path(storage_path)).metadata['crc32c']
         # TODO this may fail, maybe raise a more informative error
 
+    def size(self, storage_path) -> int:
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.bucket.meta.client.head_object(Bucket=self.bucket.name,
+                                                           Key=self._bucket_path(storage_path))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(f'{self.s3_uri}{storage_path} does not exist!')
+            raise
+        return response['ContentLength']
+
 
 class MPS3(S3, MultiprocessingMixin):
+    _connection_attributes = ('bucket',)
 
     def __init__(self,
                  bucket_factory: Callable[[], S3Bucket],
                  prefix: str = '',
                  delimiter: str = '/',
-                 cache: Cache = Cache()):
+                 cache: Cache = Cache(),
+                 part_size: int = PART_SIZE,
+                 max_concurrency: int = MAX_CONCURRENCY):
         self.bucket_factory = bucket_factory
         with self.stay_connected():
             super().__init__(bucket=self.bucket,
                              prefix=prefix,
                              delimiter=delimiter,
-                             cache=cache)
+                             cache=cache,
+                             part_size=part_size,
+                             max_concurrency=max_concurrency)
 
     def _setup_connection(self):
         self.bucket = self.bucket_factory()
@@ -238,9 +589,13 @@ class MPS3(S3, MultiprocessingMixin):
         with self.stay_connected():
             super().delete(storage_path)
 
+    def list(self) -> Iterator[StoredFile]:
+        with self.stay_connected():
+            yield from super().list()
+
     def download(self, storage_path, cache_path):
         with self.stay_connected():
-            super().download(storage_path, cache_path)
+            return super().download(storage_path, cache_path)
 
     def upload(self, cache_path, storage_path, file_hash):
         with self.stay_connected():
@@ -250,21 +605,151 @@ class MPS3(S3, MultiprocessingMixin):
         with self.stay_connected():
             return super().crc32c(storage_path)
 
+    def size(self, storage_path) -> int:
+        with self.stay_connected():
+            return super().size(storage_path)
+
+
+def _fsync(path: Path):
+    # directories are fsynced to persist the files renamed into them
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@dataclass
+class _FsyncBatch:
+    paths: set = field(default_factory=set)
+    done: bool = False
+    error: Optional[OSError] = None
+
+
+class _GroupFsync:
+    """Fsyncs files of concurrent writes together.
+
+    A write finding no fsync running fsyncs its files right away, the files of writes arriving
+    meanwhile are fsynced together next, by one of them.
+    """
+
+    def __init__(self):
+        self._batch = _FsyncBatch()
+        self._syncing = False
+        self._condition = threading.Condition()
+
+    def sync(self, *paths: Path):
+        """Adds the files to the next batch and waits for it to be fsynced."""
+        with self._condition:
+            batch = self._batch
+            batch.paths.update(paths)
+            while not batch.done:
+                if self._syncing:
+                    self._condition.wait()
+                    continue
+                # the batch waited for is the next one, this write fsyncs it
+                self._syncing = True
+                self._batch = _FsyncBatch()
+                self._condition.release()
+                try:
+                    for path in batch.paths:
+                        _fsync(path)
+                except OSError as e:
+                    batch.error = e
+                finally:
+                    self._condition.acquire()
+                    self._syncing = False
+                    batch.done = True
+                    self._condition.notify_all()
+        if batch.error is not None:
+            raise batch.error
+
 
 class LocalStorage(DirectTransportStorage):
+    """Stores files on a local filesystem, durable as given by the fsync policy.
+
+    Files are written to a partial file next to them first and renamed into place, so a crash
+    never leaves a partly written file behind, only a partial one, collected by filedb.gc.
+    """
 
     def __init__(self,
                  machine_name: str,
-                 path: Path):
+                 path: Path,
+                 fsync: str = NO_FSYNC):
+        if fsync not in (NO_FSYNC, FSYNC, GROUP_FSYNC):
+            raise ValueError(f'Unknown fsync policy {fsync}!')
+
         self.machine_name = machine_name
         self.path = Path(path)
         self.uri = f'machine://{machine_name}/{path}'
+        self.fsync = fsync
+        self._group_fsync = None
+        self._group_fsync_pid = None
 
         super().__init__(self.uri)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_group_fsync'] = None
+        state['_group_fsync_pid'] = None
+        return state
+
     def _file_path(self, storage_path):
         return self.path / storage_path[:2] / storage_path[2:]
 
+    def _crc32c_path(self, storage_path):
+        return self.path / storage_path[:2] / f'{storage_path[2:]}.crc32c'
+
+    @staticmethod
+    def _partial_path(path: Path):
+        # in the same directory, so that it can be renamed into place atomically
+        return path.with_name(f'{path.name}.{uuid.uuid4()}.partial')
+
+    def _make_directory(self, path: Path):
+        # a new shard directory is durable once the directory it was created in is fsynced
+        try:
+            path.parent.mkdir(parents=True)
+        except FileExistsError:
+            return
+        self._sync(self.path)
+
+    def _sync(self, *paths: Path):
+        # fsyncs the files as configured, with the group fsync policy together with the files
+        # of concurrent writes
+        if self.fsync == FSYNC:
+            for path in paths:
+                _fsync(path)
+        elif self.fsync == GROUP_FSYNC:
+            # one per process, as threads are not forked
+            if self._group_fsync_pid != os.getpid():
+                self._group_fsync = _GroupFsync()
+                self._group_fsync_pid = os.getpid()
+            self._group_fsync.sync(*paths)
+
+    def _publish(self, *renames: Tuple[Path, Path]):
+        # renames files into place, the data made durable before and the directories after
+        self._sync(*(partial_path for partial_path, _ in renames))
+        for partial_path, path in renames:
+            partial_path.replace(path)
+        self._sync(*{path.parent for _, path in renames})
+
+    def _partial_crc32c(self, storage_path, file_hash) -> Tuple[Path, Path]:
+        path = self._crc32c_path(storage_path)
+        partial_path = self._partial_path(path)
+        partial_path.write_text(file_hash)
+        return partial_path, path
+
+    @staticmethod
+    def _unlink(*paths: Path):
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
     @contextmanager
     def read_handle(self,
                     storage_path,
@@ -280,7 +765,6 @@ class LocalStorage(DirectTransportStorage):
                                                 newline=newline) as f:
             yield f
 
-    # TODO writing should be atomic, if possible
     # TODO raise and catch outside for more informative error
     @contextmanager
     def write_handle(self,
@@ -291,25 +775,82 @@ class LocalStorage(DirectTransportStorage):
                      errors=None,
                      newline=None):
         path = self._file_path(storage_path)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open(mode=mode,
-                       buffering=buffering,
-                       encoding=encoding,
-                       errors=errors,
-                       newline=newline) as f:
-            yield f
+        self._make_directory(path)
+        partial_path = self._partial_path(path)
+        f, file_hash = hashing_open(partial_path,
+                                    mode=mode,
+                                    buffering=buffering,
+                                    encoding=encoding,
+                                    errors=errors,
+                                    newline=newline)
+        renames = [(partial_path, path)]
+        try:
+            with f:
+                yield f
+            file_hash = file_hash()
+            if file_hash is not None:
+                renames.append(self._partial_crc32c(storage_path, file_hash))
+            # a checksum left by an earlier file would not match
+            self._unlink(self._crc32c_path(storage_path))
+            self._publish(*renames)
+        except BaseException:
+            self._unlink(*(partial_path for partial_path, _ in renames))
+            raise
 
     # TODO raise and catch outside for more informative error
     def copy(self, storage_path_1, storage_path_2):
         path_1 = self._file_path(storage_path_1)
         path_2 = self._file_path(storage_path_2)
-        path_2.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy(path_1, path_2)
+        self._make_directory(path_2)
+        partial_path = self._partial_path(path_2)
+        renames = [(partial_path, path_2)]
+        try:
+            shutil.copy(path_1, partial_path)
+            try:
+                file_hash = self._crc32c_path(storage_path_1).read_text()
+            except FileNotFoundError:
+                pass
+            else:
+                renames.append(self._partial_crc32c(storage_path_2, file_hash))
+            self._unlink(self._crc32c_path(storage_path_2))
+            self._publish(*renames)
+        except BaseException:
+            self._unlink(*(partial_path for partial_path, _ in renames))
+            raise
+
+    def move(self, storage_path_1, storage_path_2):
+        path_2 = self._file_path(storage_path_2)
+        self._make_directory(path_2)
+        renames = [(self._file_path(storage_path_1), path_2)]
+        if self._crc32c_path(storage_path_1).exists():
+            renames.append((self._crc32c_path(storage_path_1), self._crc32c_path(storage_path_2)))
+        self._unlink(self._crc32c_path(storage_path_2))
+        self._publish(*renames)
 
     # TODO raise and catch outside for more informative error
     def delete(self, storage_path):
         self._file_path(storage_path).unlink()
+        self._unlink(self._crc32c_path(storage_path))
+
+    def list(self) -> Iterator[StoredFile]:
+        # storage paths are directory names of two characters followed by file names, partial
+        # files left by crashed writes are listed too, no key points at them
+        if not self.path.exists():
+            return
+        for directory in sorted(self.path.iterdir()):
+            if len(directory.name) != 2 or not directory.is_dir():
+                continue
+            for entry in sorted(os.scandir(str(directory)), key=lambda e: e.name):
+                if entry.name.endswith('.crc32c') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                yield StoredFile(storage_path=directory.name + entry.name,
+                                 size=stat.st_size,
+                                 modified=stat.st_mtime)
 
-    # TODO cache crc32c value on disk
     def crc32c(self, storage_path):
-        return crc32c(self._file_path(storage_path))
+        # files written before crc32c was stored, or not written sequentially, have none
+        try:
+            return self._crc32c_path(storage_path).read_text()
+        except FileNotFoundError:
+            return crc32c(self._file_path(storage_path))
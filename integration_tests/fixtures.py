@@ -10,6 +10,7 @@ from pymongo import MongoClient
 from filedb.cache import Cache
 from filedb.db import FileDB
 from filedb.index import Index
+from filedb.index import KEY_DIGEST_LAYOUT
 from filedb.index import MPIndex
 from filedb.storage import GoogleCloudStorage
 from filedb.storage import LocalStorage
@@ -76,6 +77,14 @@ def local():
                          storage=LocalStorage('test_machine', local_storage_path))
 
 
+@contextmanager
+def local_key_digest():
+    with temp_mongo_db_factory() as mongo_db_factory:
+        with tempfile.TemporaryDirectory() as local_storage_path:
+            yield FileDB(index=Index(mongo_db=mongo_db_factory(), layout=KEY_DIGEST_LAYOUT),
+                         storage=LocalStorage('test_machine', local_storage_path))
+
+
 @contextmanager
 def local_mp():
     with temp_mongo_db_factory() as mongo_db_factory:
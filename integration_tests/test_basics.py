@@ -1,11 +1,34 @@
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import pytest
 
+from filedb import columns as columns_module
+from filedb import gc
+from filedb import storage as storage_module
+from filedb.db import DEFERRED
+from filedb.db import FileDB
+from filedb.db import IMMEDIATE
+from filedb.db import REVALIDATE
+from filedb.db import SupersededError
+from filedb.db import TRUST
+from filedb.query import q
+from filedb.storage import FSYNC
+from filedb.storage import GROUP_FSYNC
+from filedb.storage import LocalStorage
+from filedb.storage import NO_FSYNC
+from filedb.storage import SyncStorage
 from integration_tests.fixtures import gcs
 from integration_tests.fixtures import local
+from integration_tests.fixtures import local_key_digest
 from integration_tests.fixtures import s3
 
 
-@pytest.mark.parametrize("db_factory", [local, s3, gcs])
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
 def test_write_read(db_factory):
     with db_factory() as db:
         db.file({'a': '1'}).write_text('hi!')
@@ -33,10 +56,408 @@ def test_write_read(db_factory):
         assert db.find({}) == []
 
 
-@pytest.mark.parametrize("db_factory", [local, s3, gcs])
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
 def test_overwrite(db_factory):
     with db_factory() as db:
         db.file({'a': '1'}).write_text('hi!')
         assert db.file({'a': '1'}).read_text() == 'hi!'
         db.file({'a': '1'}).write_text('ho!')
         assert db.file({'a': '1'}).read_text() == 'ho!'
+        db.file({'a': '2'}).write_text('hi!')
+        db.file({'a': '1'}).copy({'a': '2'})
+        db.write_many([({'a': '2'}, b'he!'), ({'a': '2'}, b'hu!')])
+        assert db.file({'a': '2'}).read_text() == 'hu!'
+        # files replaced by overwrites were deleted
+        assert sorted(file.storage_path for file in db.storage.list()) == sorted(
+            file._storage_path for file in db.find({}))
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_write_many_concurrent_overwrite(db_factory):
+    with db_factory() as db:
+        db.file({'a': 1}).write_bytes(b'hi!')
+
+        def replaced_storage_paths(*args):
+            # right after write_many points the key, before it reads back what it replaced
+            db.file({'a': 1}).write_bytes(b'ho!')
+            return index_replaced_storage_paths(*args)
+
+        index_replaced_storage_paths = db.index._replaced_storage_paths
+        db.index._replaced_storage_paths = replaced_storage_paths
+        assert db.write_many([({'a': 1}, b'hu!')])[0].ok
+
+        assert db.file({'a': 1}).read_bytes() == b'ho!'
+        # neither of the replaced files leaked
+        assert [file.storage_path for file in db.storage.list()] == [
+            db.index.storage_path({'a': 1}, db.storage.name)]
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_move_over_existing_file(db_factory):
+    with db_factory() as db:
+        db.file({'a': '1'}).write_text('hi!')
+        db.file({'a': '2'}).write_text('ho!')
+        storage_path = db.index.storage_path({'a': '1'}, db.storage.name)
+
+        db.file({'a': '1'}).move({'a': '2'})
+        assert not db.file({'a': '1'}).exists()
+        assert db.file({'a': '2'}).read_text() == 'hi!'
+        # the file was not copied
+        assert db.index.storage_path({'a': '2'}, db.storage.name) == storage_path
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_files_many(db_factory):
+    with db_factory() as db:
+        db.file({'a': '1'}).write_text('hi!')
+        db.file({'a': '2'}).write_text('ho!')
+
+        files = db.files_many([{'a': '2'}, {'a': '3'}, {'a': '1'}])
+        assert files == [db.file({'a': '2'}), db.file({'a': '3'}), db.file({'a': '1'})]
+        assert files[0].read_text() == 'ho!'
+        assert files[2].read_text() == 'hi!'
+        with pytest.raises(FileNotFoundError):
+            files[1].read_text()
+
+        assert db.index.storage_paths_many([{'a': '3'}], db.storage.name) == [None]
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_iter_find(db_factory):
+    with db_factory() as db:
+        for i in range(5):
+            db.file({'a': i, 'b': 'x'}).write_text(str(i))
+
+        files = db.iter_find({}, sort=[('a', -1)], skip=1, limit=3, batch_size=2)
+        assert [f.key['a'] for f in files] == [3, 2, 1]
+        assert list(db.iter_keys({'a': 2}, fields=['b'])) == [{'b': 'x'}]
+
+        # resumed scan sees every file once
+        first = list(db.iter_find({}, limit=2))
+        rest = list(db.iter_find({}, after=first[-1].key_id))
+        assert sorted(f.key['a'] for f in first + rest) == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_found_files_are_bound(db_factory):
+    with db_factory() as db:
+        db.file({'a': '1'}).write_text('hi!')
+        trusting_db = FileDB(db.index, db.storage, staleness=TRUST)
+        [file] = db.find({'a': '1'})
+        [trusting_file] = trusting_db.find({'a': '1'})
+
+        db.index.storage_path = None  # reading must not look up the index
+        assert file.read_text() == 'hi!'
+        del db.index.storage_path
+
+        # rewritten after it was found
+        db.file({'a': '1'}).delete()
+        db.file({'a': '1'}).write_text('ho!')
+        assert file.read_text() == 'ho!'
+        with pytest.raises(FileNotFoundError):
+            trusting_file.read_text()
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_overwrite_during_bound_reads(db_factory):
+    with db_factory() as db:
+        db = FileDB(db.index, db.storage, reclaim=DEFERRED)
+        db.write_many([({'a': i}, b'hi!') for i in range(2)])
+        for staleness in [TRUST, REVALIDATE]:
+            reading_db = FileDB(db.index, db.storage, staleness=staleness)
+            files = reading_db.find({})
+            with files[0].open('rb') as f:
+                db.write_many([({'a': i}, staleness.encode()) for i in range(2)])
+                assert f.read() == b'hi!'
+            # replaced files are kept for readers bound to them, until collected
+            assert [data for _, data in reading_db.read_many(files)] == [b'hi!', b'hi!']
+            gc.collect_deferred(db, grace_period=0)
+            db.write_many([({'a': i}, b'hi!') for i in range(2)])
+
+        # deleted right away, readers bound to them look the current ones up
+        db = FileDB(db.index, db.storage, reclaim=IMMEDIATE)
+        files = db.find({})
+        db.write_many([({'a': i}, b'ho!') for i in range(2)])
+        assert [data for _, data in db.read_many(files)] == [b'ho!', b'ho!']
+        if isinstance(db.storage, SyncStorage):
+            [file] = db.find({'a': 0})
+            db.file({'a': 0}).write_bytes(b'hu!')
+            db.storage.cache.evict(db.index.storage_path({'a': 0}, db.storage.name),
+                                   storage_name=db.storage.name,
+                                   index_name=db.index.name)
+            assert file._prefetch() == 3
+            assert file.read_bytes() == b'hu!'
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_aggregations(db_factory):
+    with db_factory() as db:
+        for key in [{'a': 1, 'b': 'x'}, {'a': 1, 'b': 'y'}, {'a': 2, 'b': 'x'}, {'c': 3}]:
+            db.file(key).write_text('hi!')
+
+        assert db.count({}) == 4
+        assert db.count({'b': 'x'}) == 2
+        assert sorted(db.distinct('a')) == [1, 2]
+        assert db.distinct('b', {'a': 2}) == ['x']
+        assert sorted(db.group_count(['a'], {'b': {'$exists': True}})) == [((1,), 2), ((2,), 1)]
+        assert sorted(db.group_count(['a', 'b']), key=str) == [((1, 'x'), 1), ((1, 'y'), 1),
+                                                                ((2, 'x'), 1), ((None, None), 1)]
+
+        db.file({'c': [3, 4]}).write_text('hi!')
+        assert sorted(db.distinct('c')) == [3, 4]
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_find_columns(db_factory):
+    np = pytest.importorskip('numpy')
+    with db_factory() as db:
+        for key in [{'a': 1, 'b': 'x', 'c': 0.5}, {'a': 2, 'b': 'y'}, {'a': 3, 'b': 'x'}]:
+            db.file(key).write_text('hi!')
+
+        columns = db.find_columns({}, ['a', 'b', 'c'], categorical=['b'])
+        order = np.argsort(columns['a'].values)
+        assert columns['a'].values[order].tolist() == [1, 2, 3]
+        assert not columns['a'].mask.any()
+        assert [columns['b'].categories[c] for c in columns['b'].values[order]] == ['x', 'y', 'x']
+        assert columns['c'].mask[order].tolist() == [False, True, True]
+        assert columns['c'].values[order][0] == 0.5
+
+        pytest.importorskip('pandas')
+        df = db.find_columns({}, ['a', 'b', 'c'], categorical=['b'], dataframe=True)
+        df = df.sort_values('a')
+        assert df['b'].tolist() == ['x', 'y', 'x']
+        assert df['c'].isna().tolist() == [False, True, True]
+
+        db.file({'a': 4, 'b': ['x']}).write_text('hi!')
+        with pytest.raises(ValueError):
+            db.find_columns({}, ['b'], categorical=['b'])
+
+
+def test_columns_keep_types():
+    pytest.importorskip('numpy')
+    keys = [{'a': True, 'b': 2 ** 63}, {'a': 1, 'b': -1}, {'a': 1.0, 'b': 0}, {'a': True}]
+    result = columns_module.columns(keys, ['a', 'b'], categorical=['a'])
+    # equal, but of different types
+    assert result['a'].categories == [True, 1, 1.0]
+    assert [type(value) for value in result['a'].categories] == [bool, int, float]
+    assert result['a'].values.tolist() == [0, 1, 2, 0]
+    assert result['b'].values[:3].tolist() == [2 ** 63, -1, 0]
+
+    # also when the values of one chunk fit into int64 and of another into uint64
+    result = columns_module.columns(keys, ['b'], chunk_size=1)
+    assert result['b'].values[:3].tolist() == [2 ** 63, -1, 0]
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_write_many(db_factory):
+    with db_factory() as db, tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'data'
+        path.write_bytes(b'from path')
+        items = [({'a': 1}, b'hi!'),
+                 ({'a': 2}, path),
+                 ({'a': 3}, Path(tmp) / 'missing'),
+                 ({'a': 1}, b'ho!')]
+
+        results = db.write_many(items, chunk_size=3)
+        assert [r.ok for r in results] == [True, True, False, True]
+        assert isinstance(results[2].error, FileNotFoundError)
+        assert results[1].file.read_bytes() == b'from path'
+        assert db.file({'a': 1}).read_bytes() == b'ho!'
+        assert not db.file({'a': 3}).exists()
+
+        # within a chunk, only the last item of a key is written
+        results = db.write_many([({'a': 4}, b'he!'), ({'a': 4}, b'hu!')])
+        assert isinstance(results[0].error, SupersededError)
+        assert results[0].file._storage_path is None
+        assert results[1].ok
+        assert db.file({'a': 4}).read_bytes() == b'hu!'
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_read_many(db_factory):
+    with db_factory() as db:
+        db.write_many([({'a': i}, b'x' * i) for i in range(20)])
+
+        results = list(db.read_many({'a': {'$lt': 10}}, max_workers=4, max_inflight_bytes=10))
+        assert sorted((f.key['a'], data) for f, data in results) == [(i, b'x' * i)
+                                                                     for i in range(10)]
+        results = db.read_many(q.any({'a': q.equal(1)}, {'a': q.equal(2)}))
+        assert sorted(data for _, data in results) == [b'x', b'xx']
+
+        # files given are bound as copies
+        files = [db.file({'a': 3}), db.file({'a': 4})]
+        assert sorted(data for _, data in db.read_many(iter(files))) == [b'xxx', b'xxxx']
+        assert [file._storage_path for file in files] == [None, None]
+
+        files = [db.file({'a': 3}), db.file({'a': 30})]
+        with pytest.raises(FileNotFoundError):
+            list(db.read_many(files))
+        with pytest.raises(TypeError):
+            db.read_many([{'a': 3}])
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_prefetch(db_factory):
+    with db_factory() as db:
+        db.write_many([({'a': i}, b'x' * 10) for i in range(4)])
+
+        prefetch = db.prefetch({})
+        assert prefetch.wait(timeout=60)
+        assert prefetch.errors == []
+        # written files are cached already, local files are never cached
+        assert prefetch.files_done == 0
+        assert prefetch.files_skipped == (4 if isinstance(db.storage, SyncStorage) else 0)
+        if not isinstance(db.storage, SyncStorage):
+            return
+
+        def evict_all():
+            for file in db.find({}):
+                db.storage.cache.evict(file._storage_path,
+                                       storage_name=db.storage.name,
+                                       index_name=db.index.name)
+
+        def cached():
+            return sum(db.storage.cache.is_complete(file._storage_path,
+                                                    storage_name=db.storage.name,
+                                                    index_name=db.index.name)
+                       for file in db.find({}))
+
+        evict_all()
+        prefetch = db.prefetch({})
+        assert prefetch.wait(timeout=60)
+        assert (prefetch.files_done, prefetch.bytes_done, cached()) == (4, 40, 4)
+
+        # stops before a download would exceed max_bytes, however many run at once
+        evict_all()
+        prefetch = db.prefetch({}, max_workers=4, max_bytes=25)
+        assert prefetch.wait(timeout=60)
+        assert prefetch.errors == []
+        assert (prefetch.files_done, prefetch.bytes_done, cached()) == (2, 20, 2)
+
+        prefetch = db.prefetch({})
+        prefetch.cancel()
+        assert prefetch.wait(timeout=60)
+        assert prefetch.files_done + cached() <= 4
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_content_addressed(db_factory):
+    with db_factory() as db:
+        db = FileDB(db.index, db.storage, content_addressed=True)
+
+        def storage_path(key):
+            return db.index.storage_path(key, db.storage.name)
+
+        def refcount(path):
+            refcount_ = db.index.refcount_collection.find_one({'_id': {
+                'storage_name': db.storage.name, 'storage_path': path}})
+            return None if refcount_ is None else refcount_['count']
+
+        db.file({'a': 1}).write_text('hi!')
+        db.file({'a': 2}).write_bytes(b'hi!')
+        db.file({'a': 1}).copy({'a': 3})
+        path = storage_path({'a': 1})
+        assert storage_path({'a': 2}) == storage_path({'a': 3}) == path
+        assert refcount(path) == 3
+
+        db.file({'a': 1}).write_text('hi!')
+        db.file({'a': 3}).move({'a': 4})
+        db.file({'a': 2}).write_text('ho!')
+        assert refcount(path) == 2
+        assert db.file({'a': 2}).read_text() == 'ho!'
+        assert db.file({'a': 4}).read_text() == 'hi!'
+
+        results = db.write_many([({'a': 5}, b'ho!'), ({'a': 4}, b'ho!'), ({'a': 4}, b'hu!')])
+        assert [result.ok for result in results] == [True, False, True]
+        assert db.file({'a': 4}).read_text() == 'hu!'
+        assert refcount(path) == 1
+
+        db.file({'a': 1}).delete()
+        assert refcount(path) is None
+        with pytest.raises(RuntimeError):
+            with db.file({'a': 6}).open('wb') as f:
+                f.write(b'partial')
+                raise RuntimeError
+        assert not db.file({'a': 6}).exists()
+
+        # only content addressed files are left, no staged ones
+        if isinstance(db.storage, LocalStorage):
+            assert not db.storage._file_path(path).exists()
+            assert len(list(db.storage.path.glob('*/*'))) == 2 * 2  # with their crc32c
+        else:
+            cache_path = db.storage.cache.root_path / db.index.name / db.storage.name
+            assert sorted(p.name for p in cache_path.iterdir()) == sorted(
+                {file._storage_path for file in db.find({})})
+        assert db.count() == 3
+
+
+@pytest.mark.parametrize("fsync", [NO_FSYNC, FSYNC, GROUP_FSYNC])
+def test_local_storage_writes(tmp_path, fsync):
+    storage = LocalStorage('test_machine', tmp_path, fsync=fsync)
+    with storage.write_handle('storage_path', mode='w') as f:
+        f.write('hi!')
+        # written to a partial file, renamed into place when done
+        assert not storage._file_path('storage_path').exists()
+    storage.copy('storage_path', 'storage_path_2')
+
+    with pytest.raises(RuntimeError):
+        with storage.write_handle('storage_path', mode='w') as f:
+            f.write('ho!')
+            raise RuntimeError
+    assert storage._file_path('storage_path').read_text() == 'hi!'
+    assert storage._file_path('storage_path_2').read_text() == 'hi!'
+    assert storage.crc32c('storage_path_2') == storage.crc32c('storage_path')
+    assert [file.storage_path for file in storage.list()] == ['storage_path', 'storage_path_2']
+
+    storage = pickle.loads(pickle.dumps(storage))
+    with storage.write_handle('storage_path', mode='w') as f:
+        f.write('ho!')
+    assert storage._file_path('storage_path').read_text() == 'ho!'
+
+
+def test_local_storage_fsyncs(tmp_path, monkeypatch):
+    fsynced = []
+    monkeypatch.setattr(storage_module, '_fsync', fsynced.append)
+
+    def write(storage_path):
+        with storage.write_handle(storage_path, mode='wb') as f:
+            f.write(b'hi!')
+        return list(fsynced)
+
+    storage = LocalStorage('test_machine', tmp_path, fsync=FSYNC)
+    # the directory a new shard directory is created in too
+    assert tmp_path in write('aa_1')
+    fsynced.clear()
+    assert tmp_path not in write('aa_2')
+
+    storage = LocalStorage('test_machine', tmp_path, fsync=GROUP_FSYNC)
+    fsynced.clear()
+    # a write alone fsyncs its partial files right away, then the directory
+    assert [path.name.split('.')[0] for path in write('aa_3')] == ['_3', '_3', 'aa']
+
+    fsyncers = {}
+    fsyncing = threading.Event()
+    proceed = threading.Event()
+
+    def blocking_fsync(path):
+        fsyncers[path] = threading.current_thread()
+        fsynced.append(path)
+        fsyncing.set()
+        proceed.wait()
+
+    monkeypatch.setattr(storage_module, '_fsync', blocking_fsync)
+    with ThreadPoolExecutor(3) as executor:
+        first = executor.submit(write, 'aa_4')
+        fsyncing.wait()
+        others = [executor.submit(write, storage_path) for storage_path in ['aa_5', 'aa_6']]
+        # written while the first is fsynced, both wait for the next batch
+        while len(storage._group_fsync._batch.paths) < 4:
+            time.sleep(0.01)
+        proceed.set()
+        fsynced_before_return = [future.result() for future in [first, *others]]
+
+    for name, fsynced_paths in zip(['_4', '_5', '_6'], fsynced_before_return):
+        assert [path.name.split('.')[0] for path in fsynced_paths].count(name) == 2
+    # fsynced together, by one of them
+    assert len({fsyncers[path] for path in fsynced_before_return[2]
+                if path.name.startswith(('_5', '_6'))}) == 1
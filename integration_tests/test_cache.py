@@ -0,0 +1,191 @@
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from filedb import hash
+from filedb.cache import Cache
+from filedb.cache import FileNotCachedError
+from filedb.lock import FlockReaderWriterLock
+from filedb.lock import ReaderWriterLock
+
+
+@pytest.fixture()
+def cache_dir():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        yield Path(cache_dir)
+
+
+def _write(cache, storage_path, size):
+    with cache.writing_path(storage_path, 'storage_name', 'index_name', timeout=None) as path:
+        path.write_bytes(b'x' * size)
+
+
+def _is_cached(cache, storage_path):
+    try:
+        with cache.reading_path(storage_path, 'storage_name', 'index_name', timeout=None):
+            return True
+    except FileNotCachedError:
+        return False
+
+
+def test_usage_is_tracked(cache_dir):
+    cache = Cache(cache_dir, size=None)
+    _write(cache, 'a', 100)
+    _write(cache, 'b', 200)
+    assert cache.registry.usage() == 300
+
+    # rewriting does not count twice
+    _write(cache, 'b', 50)
+    assert cache.registry.usage() == 150
+
+
+def test_least_recently_accessed_are_evicted(cache_dir):
+    cache = Cache(cache_dir, size=1000, low_water_mark=0.5)
+    for storage_path in ['a', 'b', 'c', 'd']:
+        _write(cache, storage_path, 300)
+    assert _is_cached(cache, 'a')
+
+    # usage is above size, so the least recently accessed b, c and d are evicted to get
+    # under 500 (a was just read, a and d would be 600), then e is written
+    _write(cache, 'e', 300)
+
+    assert [_is_cached(cache, p) for p in ['a', 'b', 'c', 'd', 'e']] == [True, False, False,
+                                                                          False, True]
+    assert cache.registry.usage() == 600
+
+
+def _hold_read_lock(cache_dir, lock_class, locked, release):
+    cache = Cache(cache_dir, size=1000, low_water_mark=0, lock_class=lock_class)
+    with cache.reading_path('a', 'storage_name', 'index_name', timeout=None):
+        locked.set()
+        release.wait()
+
+
+@pytest.mark.parametrize("lock_class", [ReaderWriterLock, FlockReaderWriterLock])
+def test_files_being_read_are_not_evicted(cache_dir, lock_class):
+    cache = Cache(cache_dir, size=1000, low_water_mark=0, lock_class=lock_class)
+    for storage_path in ['a', 'b', 'c', 'd']:
+        _write(cache, storage_path, 300)
+
+    locked = multiprocessing.Event()
+    release = multiprocessing.Event()
+    reader = multiprocessing.Process(target=_hold_read_lock,
+                                     args=(cache_dir, lock_class, locked, release))
+    reader.start()
+    try:
+        locked.wait()
+        _write(cache, 'e', 300)
+    finally:
+        release.set()
+        reader.join()
+
+    assert [_is_cached(cache, p) for p in ['a', 'b', 'c', 'd', 'e']] == [True, False, False,
+                                                                          False, True]
+
+
+def test_wal_registry_flushes_accesses(cache_dir):
+    cache = Cache(cache_dir, size=1000, low_water_mark=0.5, wal_registry=True)
+    for storage_path in ['a', 'b', 'c', 'd']:
+        _write(cache, storage_path, 300)
+
+    # buffered access to a must be flushed before cleanup picks files to evict
+    assert _is_cached(cache, 'a')
+    _write(cache, 'e', 300)
+
+    assert [_is_cached(cache, p) for p in ['a', 'b', 'c', 'd', 'e']] == [True, False, False,
+                                                                          False, True]
+    assert cache.registry.usage() == 600
+    assert Cache(cache_dir, size=1000).registry.usage() == 600
+
+
+def _fetch_and_read(cache_dir, lock_class, fetches_dir):
+
+    def fetch(path):
+        (Path(fetches_dir) / str(time.monotonic())).touch()
+        time.sleep(0.5)
+        path.write_text('hi!')
+
+    cache = Cache(cache_dir, lock_class=lock_class)
+    with cache.fetching_path('a', 'storage_name', 'index_name', fetch) as path:
+        return path.read_text()
+
+
+@pytest.mark.parametrize("lock_class", [ReaderWriterLock, FlockReaderWriterLock])
+def test_concurrent_misses_fetch_once(cache_dir, lock_class):
+    with tempfile.TemporaryDirectory() as fetches_dir:
+
+        with ThreadPoolExecutor(4) as executor:
+            thread_results = [executor.submit(_fetch_and_read, cache_dir, lock_class, fetches_dir)
+                              for _ in range(4)]
+
+            # forking while other threads use sqlite breaks sqlite locking in the child
+            with multiprocessing.get_context('spawn').Pool(4) as pool:
+                process_results = pool.starmap(_fetch_and_read,
+                                               [(cache_dir, lock_class, fetches_dir)] * 4)
+
+        assert [r.result() for r in thread_results] + process_results == ['hi!'] * 8
+        assert len(list(Path(fetches_dir).iterdir())) == 1
+
+
+def test_failed_fetch_is_not_cached(cache_dir):
+    cache = Cache(cache_dir)
+
+    def fail(path):
+        path.write_text('partial')
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        with cache.fetching_path('a', 'storage_name', 'index_name', fail):
+            pass
+    assert not _is_cached(cache, 'a')
+
+
+class _NoLock:
+    def __init__(self, directory):
+        raise AssertionError('cache hits should not take locks')
+
+
+@pytest.mark.parametrize("wal_registry", [False, True])
+def test_hits_are_read_without_locks(cache_dir, wal_registry):
+    cache = Cache(cache_dir, size=1000, low_water_mark=0.5, wal_registry=wal_registry)
+    for storage_path in ['a', 'b', 'c', 'd']:
+        _write(cache, storage_path, 300)
+
+    lock_class = cache.lock_class
+    cache.lock_class = cache.registry.lock_class = _NoLock
+    with cache.opened('a', 'storage_name', 'index_name', fetch=None, mode='rb') as f:
+        assert f.read() == b'x' * 300
+
+    # the access was recorded, and is flushed before cleanup
+    cache.lock_class = cache.registry.lock_class = lock_class
+    _write(cache, 'e', 300)
+    assert [_is_cached(cache, p) for p in ['a', 'b', 'c', 'd', 'e']] == [True, False, False,
+                                                                          False, True]
+
+
+def test_open_files_survive_eviction(cache_dir):
+    cache = Cache(cache_dir, size=1000, low_water_mark=0)
+    for storage_path in ['a', 'b', 'c', 'd']:
+        _write(cache, storage_path, 300)
+
+    with cache.opened('a', 'storage_name', 'index_name', fetch=None, mode='rb') as f:
+        _write(cache, 'e', 300)
+        assert not _is_cached(cache, 'a')
+        assert f.read() == b'x' * 300
+
+    assert list((cache_dir / 'trash').iterdir()) == []
+
+
+def test_written_files_are_hashed_once(cache_dir, monkeypatch):
+    cache = Cache(cache_dir)
+    monkeypatch.setattr(hash, 'crc32c', None)  # no re-reading
+    with cache.writing_handle('a', 'storage_name', 'index_name', timeout=None, mode='w') as f:
+        f.write('hi!')
+
+    monkeypatch.undo()
+    with cache.reading_path('a', 'storage_name', 'index_name', timeout=None) as path:
+        assert cache.crc32c('a', 'storage_name', 'index_name') == hash.crc32c(path)
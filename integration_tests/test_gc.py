@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from filedb import gc
+from filedb.db import DEFERRED
+from filedb.db import FileDB
+from integration_tests.fixtures import gcs
+from integration_tests.fixtures import local
+from integration_tests.fixtures import local_key_digest
+from integration_tests.fixtures import s3
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_collect(db_factory):
+    with db_factory() as db:
+        db.write_many([({'a': i}, b'x' * i) for i in range(5)])
+        db.file({'a': 0}).copy({'a': 5})
+        # as if a write crashed before the index pointed at it
+        db.file({'a': 6})._write_storage('orphan', b'orphan')
+
+        report = gc.collect(db)
+        assert (report.files, report.referenced, report.recent) == (7, 6, 1)
+        assert report.garbage == []
+
+        report = gc.collect(db, grace_period=0, dry_run=True, batch_size=2)
+        assert report.garbage == ['orphan']
+        assert report.garbage_size == len(b'orphan')
+
+        report = gc.collect(db, grace_period=0, batch_size=2)
+        assert report.garbage == ['orphan']
+        assert report.errors == []
+        assert [file.storage_path for file in db.storage.list()] == sorted(
+            file._storage_path for file in db.find({}))
+        assert all(db.file({'a': i}).read_bytes() == b'x' * i for i in range(5))
+
+        assert gc.collect(db, grace_period=0).garbage == []
+
+
+def test_collect_partial_files():
+    with local() as db:
+        db.file({'a': 1}).write_bytes(b'hi!')
+        storage_path = db.index.storage_path({'a': 1}, db.storage.name)
+        # as if a write crashed before the file was renamed into place
+        partial_path = db.storage._partial_path(db.storage._file_path(storage_path))
+        partial_path.write_bytes(b'h')
+
+        assert gc.collect(db).recent == 1
+        report = gc.collect(db, grace_period=0)
+        assert report.garbage == [storage_path[:2] + partial_path.name]
+        assert not partial_path.exists()
+        assert db.file({'a': 1}).read_bytes() == b'hi!'
+
+
+@pytest.mark.parametrize("db_factory", [local, s3, gcs])
+def test_collect_content_addressed(db_factory):
+    with db_factory() as db:
+        db = FileDB(db.index, db.storage, content_addressed=True)
+        db.file({'a': 1}).write_bytes(b'hi!')
+        db.file({'a': 2}).write_bytes(b'hi!')
+        db.file({'a': 1}).delete()
+
+        report = gc.collect(db, grace_period=0)
+        assert (report.files, report.referenced, report.garbage) == (1, 1, [])
+        assert db.file({'a': 2}).read_bytes() == b'hi!'
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_collect_deferred(db_factory):
+    with db_factory() as db:
+        db = FileDB(db.index, db.storage, reclaim=DEFERRED)
+        db.file({'a': 1}).write_bytes(b'hi!')
+        replaced = db.index.storage_path({'a': 1}, db.storage.name)
+        db.file({'a': 1}).write_bytes(b'ho!')
+        db.file({'a': 1}).delete()
+        assert len(list(db.storage.list())) == 2
+
+        assert gc.collect_deferred(db).garbage == []
+        assert replaced in [file.storage_path for file in db.storage.list()]
+
+        report = gc.collect_deferred(db, grace_period=0)
+        assert len(report.garbage) == 2
+        assert list(db.storage.list()) == []
+        assert gc.collect_deferred(db, grace_period=0).garbage == []
+
+
+@pytest.mark.parametrize("db_factory", [local, local_key_digest, s3, gcs])
+def test_collect_deferred_queued_again(db_factory):
+    with db_factory() as db:
+        db = FileDB(db.index, db.storage, reclaim=DEFERRED)
+        db.file({'a': 1}).write_bytes(b'hi!')
+        replaced = db.index.storage_path({'a': 1}, db.storage.name)
+        db.file({'a': 1}).write_bytes(b'ho!')
+        time.sleep(0.2)
+        # as content addressed files are, once referenced and released again
+        db.index.defer_deletion(replaced, db.storage.name)
+
+        assert gc.collect_deferred(db, grace_period=0.1).garbage == []
+        assert list(db.index.deferred_deletions(db.storage.name, time.time())) == [replaced]
+        assert gc.collect_deferred(db, grace_period=0).garbage == [replaced]
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from filedb.hash import Crc32c
+from filedb.hash import backends
+from filedb.hash import crc32c
+from filedb.hash import crc32c_combine_many
+from filedb.hash import hashing_open
+
+
+def _crc32c(data):
+    crc = Crc32c()
+    crc.update(data)
+    return crc.value
+
+
+def test_crc32c_check_value():
+    assert _crc32c(b'123456789') == 0xE3069283
+
+
+@pytest.mark.parametrize("backend", backends())
+def test_crc32c_backends_agree(tmp_path, backend):
+    data = os.urandom(10000)
+    (tmp_path / 'data').write_bytes(data)
+    crc = Crc32c(backend)
+    crc.update(data[:777])
+    crc.update(memoryview(data)[777:])
+    assert crc.value == _crc32c(data)
+    assert crc32c(tmp_path / 'data', backend) == crc.base64()
+
+
+def test_crc32c_combine():
+    parts = [os.urandom(size) for size in [1000, 0, 1, 777, 4096]]
+    assert crc32c_combine_many((_crc32c(part), len(part)) for part in parts) == \
+        _crc32c(b''.join(parts))
+    assert crc32c_combine_many([]) == _crc32c(b'')
+
+
+@pytest.mark.parametrize("mode, data, kwargs", [('wb', os.urandom(100000), {}),
+                                                ('wb', b'abc', {'buffering': 0}),
+                                                ('w', 'héllo\n' * 1000, {'encoding': 'utf-16'})])
+def test_hashing_open(tmp_path, mode, data, kwargs):
+    f, file_hash = hashing_open(tmp_path / 'data', mode, **kwargs)
+    with f:
+        f.write(data)
+    assert file_hash() == crc32c(tmp_path / 'data')
+
+
+def test_hashing_open_gives_up_on_seeks(tmp_path):
+    f, file_hash = hashing_open(tmp_path / 'data', 'wb')
+    with f:
+        f.write(b'abc')
+        f.seek(0)
+        f.write(b'x')
+    assert file_hash() is None
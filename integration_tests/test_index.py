@@ -0,0 +1,138 @@
+import gc
+import time
+import weakref
+
+import pytest
+
+from filedb.index import Index
+from filedb.index import KEY_DIGEST_LAYOUT
+from filedb.index import KEY_ID_LAYOUT
+from filedb.index import MPIndex
+from integration_tests.fixtures import temp_mongo_db_factory
+
+
+@pytest.fixture
+def mongo_db_factory():
+    with temp_mongo_db_factory() as mongo_db_factory:
+        yield mongo_db_factory
+
+
+def test_layout_is_persisted(mongo_db_factory):
+    index = Index(mongo_db_factory(), layout=KEY_DIGEST_LAYOUT)
+    assert Index(mongo_db_factory()).layout == KEY_DIGEST_LAYOUT
+    assert Index(mongo_db_factory()).name == index.name
+
+    with pytest.raises(ValueError):
+        Index(mongo_db_factory(), layout=KEY_ID_LAYOUT)
+
+
+@pytest.mark.parametrize("layout", [KEY_ID_LAYOUT, KEY_DIGEST_LAYOUT])
+def test_layouts(mongo_db_factory, layout):
+    index = Index(mongo_db_factory(), layout=layout)
+    index.upsert({'a': 1, 'b': 2}, 'storage_path_1', 'storage_name')
+    index.upsert({'a': 2}, 'storage_path_2', 'storage_name')
+
+    assert index.storage_path({'b': 2, 'a': 1}, 'storage_name') == 'storage_path_1'
+    assert index.storage_path({'a': 3}, 'storage_name') is None
+    assert index.storage_paths_many([{'a': 2}, {'a': 3}], 'storage_name') == ['storage_path_2',
+                                                                              None]
+    assert list(index.find({'a': 2}, 'storage_name')) == [{'a': 2}]
+
+    index.upsert({'a': 2}, 'storage_path_3', 'storage_name')
+    assert index.storage_path({'a': 2}, 'storage_name') == 'storage_path_3'
+
+    index.delete({'a': 2}, 'storage_name')
+    assert index.storage_path({'a': 2}, 'storage_name') is None
+
+
+def test_migrate_to_key_digest(mongo_db_factory):
+    index = Index(mongo_db_factory())
+    keys = [{'a': i, 'b': {'c': str(i)}} for i in range(10)]
+    for i, key in enumerate(keys):
+        index.upsert(key, f'storage_path_{i}', 'storage_name_1')
+        index.upsert(key, f'storage_path_{i}', 'storage_name_2')
+
+    index.migrate_to_key_digest(chunk_size=3)
+
+    assert index.layout == KEY_DIGEST_LAYOUT
+    assert Index(mongo_db_factory()).layout == KEY_DIGEST_LAYOUT
+    assert 'key_id' not in mongo_db_factory().list_collection_names()
+    for storage_name in ['storage_name_1', 'storage_name_2']:
+        assert index.storage_paths_many(keys, storage_name) == [f'storage_path_{i}'
+                                                                for i in range(10)]
+        assert len(list(index.find({}, storage_name))) == 10
+
+
+@pytest.mark.parametrize("layout", [KEY_ID_LAYOUT, KEY_DIGEST_LAYOUT])
+def test_upsert_many(mongo_db_factory, layout):
+    index = Index(mongo_db_factory(), layout=layout)
+    index.upsert({'a': 1}, 'storage_path_0', 'storage_name')
+
+    items = [({'a': i}, f'storage_path_{i}') for i in range(1, 5)] + [({'a': 2}, 'last')]
+    assert index.upsert_many(items, 'storage_name', chunk_size=3) == [
+        ('storage_path_0', None), (None, None), (None, None), (None, None),
+        ('storage_path_2', None)]
+    assert index.storage_paths_many([{'a': i} for i in range(1, 5)], 'storage_name') == [
+        'storage_path_1', 'last', 'storage_path_3', 'storage_path_4']
+
+    # items of a key within a chunk replace each other in order
+    items = [({'a': 1}, 'first'), ({'a': 1}, 'second')]
+    assert index.upsert_many(items, 'storage_name') == [('storage_path_1', None),
+                                                        ('first', None)]
+    assert sorted(entry.key['a'] for entry in index.find_entries({}, 'storage_name')) == [
+        1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("layout", [KEY_ID_LAYOUT, KEY_DIGEST_LAYOUT])
+def test_move(mongo_db_factory, layout):
+    index = Index(mongo_db_factory(), layout=layout)
+    index.upsert({'a': 1}, 'storage_path_1', 'storage_name')
+    index.upsert({'a': 2}, 'storage_path_2', 'storage_name')
+
+    assert index.move({'a': 1}, {'a': 3}, 'storage_name') == ('storage_path_1', None)
+    assert index.move({'a': 3}, {'a': 2}, 'storage_name') == ('storage_path_1', 'storage_path_2')
+    assert index.storage_paths_many([{'a': 1}, {'a': 2}, {'a': 3}], 'storage_name') == [
+        None, 'storage_path_1', None]
+    assert [entry.key for entry in index.find_entries({}, 'storage_name')] == [{'a': 2}]
+
+    with pytest.raises(FileNotFoundError):
+        index.move({'a': 1}, {'a': 2}, 'storage_name')
+
+
+def test_refcounts(mongo_db_factory):
+    index = Index(mongo_db_factory())
+
+    assert index.incref('storage_path', 'storage_name')  # to be stored
+    index.stored('storage_path', 'storage_name')
+    assert not index.incref('storage_path', 'storage_name')
+    assert not index.decref('storage_path', 'storage_name')
+    assert index.decref('storage_path', 'storage_name')  # last reference, to be deleted
+    index.deleted('storage_path', 'storage_name')
+    assert index.incref('storage_path', 'storage_name')
+
+    # files written without refcounts are deleted with their only reference
+    assert index.decref('other_storage_path', 'storage_name')
+
+
+def test_deferred_deletions(mongo_db_factory):
+    index = Index(mongo_db_factory())
+    index.defer_deletion('old', 'storage_name')
+    time.sleep(0.01)
+    deferred_before = time.time()
+    index.defer_deletion('new', 'storage_name')
+    assert list(index.deferred_deletions('storage_name', deferred_before)) == ['old']
+
+    # files queued since deferred_before are not claimed
+    assert index.claim_deletions(['old', 'new'], 'storage_name', deferred_before) == ['old']
+    index.deleted('old', 'storage_name')
+    # only entries queued before deferred_before are removed
+    index.remove_deferred_deletions(['old', 'new'], 'storage_name', deferred_before)
+    assert list(index.deferred_deletions('storage_name', time.time())) == ['new']
+
+
+def test_connected_mp_index_can_be_collected(mongo_db_factory):
+    index = MPIndex(mongo_db_factory)
+    assert index.storage_path({'a': 1}, 'storage_name') is None
+    index = weakref.ref(index)
+    gc.collect()
+    assert index() is None
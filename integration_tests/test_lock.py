@@ -5,7 +5,9 @@ import itertools
 import os
 import random
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
 from pathlib import Path
 
@@ -17,6 +19,7 @@ from diskcache import Deque
 from pathos.pools import _ProcessPool as ProcessPool
 
 from filedb.lock import FileLocked
+from filedb.lock import FlockReaderWriterLock
 from filedb.lock import ReaderWriterLock
 
 PROCESS_COUNT = 20
@@ -66,16 +69,21 @@ def disk_cache_dir():
         yield disk_cache_dir
 
 
+@pytest.fixture(params=[ReaderWriterLock, FlockReaderWriterLock])
+def lock_class(request):
+    return request.param
+
+
 @pytest.fixture()
 def lock_dir():
     with tempfile.TemporaryDirectory() as disk_cache_dir:
         yield disk_cache_dir
 
 
-def test_doesnt_hang(lock_dir, disk_cache_dir):
+def test_doesnt_hang(lock_dir, disk_cache_dir, lock_class):
     def chaotic_locker(type_):
-        lock = (ReaderWriterLock(lock_dir).write_lock if type_ == 'w' else
-                ReaderWriterLock(lock_dir).read_lock)
+        lock = (lock_class(lock_dir).write_lock if type_ == 'w' else
+                lock_class(lock_dir).read_lock)
         with lock():
             with Cache(disk_cache_dir) as dc_:
                 dc_.incr(type_)
@@ -88,12 +96,12 @@ def test_doesnt_hang(lock_dir, disk_cache_dir):
         assert dc.get('r') == 10
 
 
-def test_no_double_writers(disk_cache_dir, lock_dir):
+def test_no_double_writers(disk_cache_dir, lock_dir, lock_class):
     watch = StopWatch(duration=5)
     watch.start()
 
     def acquire_check(dc_):
-        with ReaderWriterLock(lock_dir).write_lock(timeout=None):
+        with lock_class(lock_dir).write_lock(timeout=None):
             if dc_.get('active_count', 0) >= 1:
                 dc_.incr('dups_count')
             dc_.incr('active_count')
@@ -116,15 +124,15 @@ def test_no_double_writers(disk_cache_dir, lock_dir):
         assert dc.get('visited_count') > 100
 
 
-def test_no_concurrent_readers_writers(disk_cache_dir, lock_dir):
+def test_no_concurrent_readers_writers(disk_cache_dir, lock_dir, lock_class):
     watch = StopWatch(duration=5)
     watch.start()
 
     def acquire_check(dc_, reader):
         if reader:
-            lock_func = ReaderWriterLock(lock_dir).read_lock
+            lock_func = lock_class(lock_dir).read_lock
         else:
-            lock_func = ReaderWriterLock(lock_dir).write_lock
+            lock_func = lock_class(lock_dir).write_lock
         with lock_func(timeout=None):
             if not reader:
                 if dc_.get('active_count', 0) >= 1:
@@ -149,9 +157,9 @@ def test_no_concurrent_readers_writers(disk_cache_dir, lock_dir):
         assert dc.get('visited_count') > 10
 
 
-def test_writer_releases_lock_upon_crash(lock_dir, disk_cache_dir):
+def test_writer_releases_lock_upon_crash(lock_dir, disk_cache_dir, lock_class):
     def lock_(i, crash):
-        with ReaderWriterLock(lock_dir).write_lock(timeout=5):
+        with lock_class(lock_dir).write_lock(timeout=5):
             with Cache(disk_cache_dir) as dc_:
                 dc_.set(f'pid{i}', os.getpid())
             if crash:
@@ -173,15 +181,15 @@ def test_writer_releases_lock_upon_crash(lock_dir, disk_cache_dir):
     assert p2.exitcode == 0
 
 
-def test_reader_releases_lock_upon_crash(lock_dir, disk_cache_dir):
+def test_reader_releases_lock_upon_crash(lock_dir, disk_cache_dir, lock_class):
     def read_lock_and_crash(i):
-        with ReaderWriterLock(lock_dir).read_lock():
+        with lock_class(lock_dir).read_lock():
             with Cache(disk_cache_dir) as dc_:
                 dc_.set(f'pid{i}', os.getpid())
             raise RuntimeError('')
 
     def write_lock(i):
-        with ReaderWriterLock(lock_dir).write_lock(timeout=5):
+        with lock_class(lock_dir).write_lock(timeout=5):
             with Cache(disk_cache_dir) as dc_:
                 dc_.set(f'pid{i}', os.getpid())
 
@@ -201,10 +209,10 @@ def test_reader_releases_lock_upon_crash(lock_dir, disk_cache_dir):
     assert p2.exitcode == 0
 
 
-def test_reader_writer_chaotic(lock_dir, disk_cache_dir):
+def test_reader_writer_chaotic(lock_dir, disk_cache_dir, lock_class):
     def chaotic_locker(type_, blow_up):
-        lock = (ReaderWriterLock(lock_dir).write_lock if type_ == 'w' else
-                ReaderWriterLock(lock_dir).read_lock)
+        lock = (lock_class(lock_dir).write_lock if type_ == 'w' else
+                lock_class(lock_dir).read_lock)
         with lock():
             with Cache(disk_cache_dir) as dc_:
                 dc_.incr(type_)
@@ -223,8 +231,55 @@ def test_reader_writer_chaotic(lock_dir, disk_cache_dir):
         assert dc.get('r') == 20
 
 
-def test_reader_to_writer(lock_dir):
-    lock = ReaderWriterLock(lock_dir)
+def test_threads_no_concurrent_readers_writers(lock_dir, lock_class):
+    watch = StopWatch(duration=2)
+    watch.start()
+    counts = {'readers': 0, 'writers': 0, 'max_readers': 0, 'dups': 0, 'visited': 0}
+    counts_lock = threading.Lock()
+
+    def acquire_check(reader):
+        if reader:
+            lock_func = lock_class(lock_dir).read_lock
+        else:
+            lock_func = lock_class(lock_dir).write_lock
+        with lock_func(timeout=None):
+            with counts_lock:
+                if counts['writers'] or (not reader and counts['readers']):
+                    counts['dups'] += 1
+                counts['readers' if reader else 'writers'] += 1
+                counts['max_readers'] = max(counts['max_readers'], counts['readers'])
+            time.sleep(random.random() / 1000)
+            with counts_lock:
+                counts['readers' if reader else 'writers'] -= 1
+                counts['visited'] += 1
+
+    def run(_):
+        while not watch.expired():
+            acquire_check(random.random() < 0.8)
+
+    with ThreadPoolExecutor(PROCESS_COUNT) as executor:
+        list(executor.map(run, range(PROCESS_COUNT)))
+
+    assert counts['dups'] == 0
+    assert counts['max_readers'] > 1
+    assert counts['visited'] > 100
+
+
+def test_forked_child_does_not_hold_lock(lock_dir, lock_class):
+    with lock_class(lock_dir).write_lock(timeout=1):
+        child = Process(target=time.sleep, args=(5,))
+        child.start()
+
+    try:
+        with lock_class(lock_dir).write_lock(timeout=1):
+            pass
+    finally:
+        child.terminate()
+        child.join()
+
+
+def test_reader_to_writer(lock_dir, lock_class):
+    lock = lock_class(lock_dir)
 
     with lock.read_lock(timeout=1):
         with lock.write_lock(timeout=1):
@@ -232,8 +287,8 @@ def test_reader_to_writer(lock_dir):
 
 
 @pytest.mark.skip('Not supported!')
-def test_reader_to_reader(lock_dir):
-    lock = ReaderWriterLock(lock_dir)
+def test_reader_to_reader(lock_dir, lock_class):
+    lock = lock_class(lock_dir)
 
     with lock.read_lock(timeout=1):
         with lock.read_lock(timeout=1):
@@ -246,8 +301,8 @@ def test_reader_to_reader(lock_dir):
 
 
 @pytest.mark.skip('Not supported!')
-def test_writer_to_reader(lock_dir):
-    lock = ReaderWriterLock(lock_dir)
+def test_writer_to_reader(lock_dir, lock_class):
+    lock = lock_class(lock_dir)
 
     # fails to release second time, as is already released
     with lock.write_lock(timeout=1):
@@ -256,8 +311,8 @@ def test_writer_to_reader(lock_dir):
 
 
 @pytest.mark.skip('Not supported!')
-def test_writer_to_writer(lock_dir):
-    lock = ReaderWriterLock(lock_dir)
+def test_writer_to_writer(lock_dir, lock_class):
+    lock = lock_class(lock_dir)
 
     # fails to release second time, as is already released
     with lock.write_lock(timeout=1):
@@ -273,13 +328,13 @@ def _find_overlaps(times, start, end):
     return overlaps
 
 
-def _spawn_variation(readers, writers, lock_dir, disk_cache_dir):
+def _spawn_variation(readers, writers, lock_dir, disk_cache_dir, lock_class):
     times = {'w': Deque(directory=disk_cache_dir / 'w'),
              'r': Deque(directory=disk_cache_dir / 'r')}
 
     def func(type_):
-        lock = (ReaderWriterLock(lock_dir).write_lock if type_ == 'w' else
-                ReaderWriterLock(lock_dir).read_lock)
+        lock = (lock_class(lock_dir).write_lock if type_ == 'w' else
+                lock_class(lock_dir).read_lock)
         with lock(timeout=5):
             enter_time = time.monotonic()
             time.sleep(random.random() / 100)
@@ -292,8 +347,9 @@ def _spawn_variation(readers, writers, lock_dir, disk_cache_dir):
     return list(times['w']), list(times['r'])
 
 
-def test_multi_reader_multi_writer(lock_dir, disk_cache_dir):
-    writer_times, reader_times = _spawn_variation(10, 10, Path(lock_dir), Path(disk_cache_dir))
+def test_multi_reader_multi_writer(lock_dir, disk_cache_dir, lock_class):
+    writer_times, reader_times = _spawn_variation(10, 10, Path(lock_dir), Path(disk_cache_dir),
+                                                    lock_class)
     assert len(writer_times) == 10
     assert len(reader_times) == 10
     for start, stop in writer_times:
@@ -303,16 +359,18 @@ def test_multi_reader_multi_writer(lock_dir, disk_cache_dir):
         assert _find_overlaps(writer_times, start, stop) == 0
 
 
-def test_multi_reader_single_writer(lock_dir, disk_cache_dir):
-    writer_times, reader_times = _spawn_variation(9, 1, Path(lock_dir), Path(disk_cache_dir))
+def test_multi_reader_single_writer(lock_dir, disk_cache_dir, lock_class):
+    writer_times, reader_times = _spawn_variation(9, 1, Path(lock_dir), Path(disk_cache_dir),
+                                                    lock_class)
     assert len(writer_times) == 1
     assert len(reader_times) == 9
     start, stop = writer_times[0]
     assert _find_overlaps(reader_times, start, stop) == 0
 
 
-def test_multi_writer(lock_dir, disk_cache_dir):
-    writer_times, reader_times = _spawn_variation(0, 10, Path(lock_dir), Path(disk_cache_dir))
+def test_multi_writer(lock_dir, disk_cache_dir, lock_class):
+    writer_times, reader_times = _spawn_variation(0, 10, Path(lock_dir), Path(disk_cache_dir),
+                                                    lock_class)
     assert len(writer_times) == 10
     assert len(reader_times) == 0
 
@@ -16,3 +16,11 @@ def test_multiple_readers_of_same_file(db_factory):
         pool = ProcessPool(2)
         results = pool.map(read_and_check, [() for _ in range(4)], chunksize=1)
         assert all(results)
+
+
+def test_connection_is_reused():
+    with local_mp() as db:
+        db.file({'a': '1'}).write_text('hi!')
+        mongo_db = db.index.mongo_db
+        assert db.file({'a': '1'}).read_text() == 'hi!'
+        assert db.index.mongo_db is mongo_db